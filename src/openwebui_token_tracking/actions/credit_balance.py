@@ -11,8 +11,10 @@ import os
 import logging
 
 from openwebui_token_tracking.tracking import TokenTracker
-from openwebui_token_tracking.pipes.base_tracked_pipe import _time_to_month_end
-import time
+from openwebui_token_tracking.pipes.base_tracked_pipe import (
+    _BALANCE_CACHE,
+    _time_to_month_end,
+)
 
 
 class CreditBalance:
@@ -62,13 +64,15 @@ class CreditBalance:
                 "data": {"description": "Getting credit balance...", "done": False},
             }
         )
-        time.sleep(0.5)
 
         logger = logging.getLogger(__name__)
 
-        tracker_instance = TokenTracker(db_url=os.environ[self.DATABASE_URL_ENV])
-        credits_left, _ = tracker_instance.remaining_credits(user=__user__)
-        max_credits = tracker_instance.max_credits(user=__user__)
+        balance = _BALANCE_CACHE.get(__user__["id"])
+        if balance is None:
+            tracker_instance = TokenTracker.shared(os.environ[self.DATABASE_URL_ENV])
+            balance = await tracker_instance.aget_balance_summary(user=__user__)
+            _BALANCE_CACHE.set(__user__["id"], balance)
+        credits_left, max_credits = balance
 
         stats = " | ".join(
             [
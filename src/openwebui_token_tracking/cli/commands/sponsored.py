@@ -91,8 +91,10 @@ def list_sponsored(database_url: str):
     DATABASE-URL is expected to be in SQLAlchemy format.
     """
     models = sp.get_sponsored_allowances(database_url=database_url)
-    for model in models:
-        click.echo(model)
+    # Write the listing at once rather than flushing stdout once per allowance
+    output = "\n".join(str(model) for model in models)
+    if output:
+        click.echo(output)
 
 
 @sponsored.command(name="update")
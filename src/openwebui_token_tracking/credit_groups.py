@@ -1,7 +1,7 @@
 import sqlalchemy as db
 from sqlalchemy.orm import Session
 
-from openwebui_token_tracking.db import init_db
+from openwebui_token_tracking.db import get_engine
 from openwebui_token_tracking.db.credit_group import CreditGroup, CreditGroupUser
 from openwebui_token_tracking.db.user import User
 from openwebui_token_tracking.user import serialize_user
@@ -30,7 +30,7 @@ def create_credit_group(
 
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
 
     with Session(engine) as session:
         # Make sure credit group of that name does not already exist
@@ -69,7 +69,7 @@ def get_credit_group(credit_group_name: str, database_url: str = None) -> dict:
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         credit_group = (
             session.query(CreditGroup).filter_by(name=credit_group_name).first()
@@ -95,7 +95,7 @@ def list_credit_groups(database_url: str = None) -> list[dict]:
     """
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
 
     with Session(engine) as session:
         credit_groups = session.query(CreditGroup).all()
@@ -151,7 +151,7 @@ def update_credit_group(
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         credit_group = (
             session.query(CreditGroup).filter_by(name=credit_group_name).first()
@@ -196,7 +196,7 @@ def upsert_credit_group(
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         credit_group = (
             session.query(CreditGroup).filter_by(name=credit_group_name).first()
@@ -239,7 +239,7 @@ def delete_credit_group(
     """
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
 
     with Session(engine) as session:
         # Find the credit group
@@ -287,7 +287,7 @@ def add_user(user_id: str, credit_group_name: str, database_url: str = None):
     """
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
 
     with Session(engine) as session:
         credit_group = (
@@ -317,7 +317,7 @@ def remove_user(user_id: str, credit_group_name: str, database_url: str = None):
     """
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
 
     with Session(engine) as session:
         # Find the credit group
@@ -362,7 +362,7 @@ def list_users(credit_group_name: str, database_url: str = None) -> list[dict]:
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         # Find the credit group
         credit_group = (
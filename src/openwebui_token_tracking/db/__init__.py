@@ -1,4 +1,4 @@
-from .db import migrate_database, init_db
+from .db import migrate_database, init_db, get_engine
 from .credit_group import CreditGroup, CreditGroupUser
 from .model_pricing import ModelPricing
 from .settings import BaseSetting
@@ -9,6 +9,7 @@ from .user import User
 __all__ = [
     "migrate_database",
     "init_db",
+    "get_engine",
     "CreditGroup",
     "CreditGroupUser",
     "ModelPricing",
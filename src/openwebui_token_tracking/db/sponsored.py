@@ -32,6 +32,13 @@ class SponsoredAllowanceBaseModels(Base):
     """Relationship with the :class:`SponsoredAllowance` model, linked via :attr:`SponsoredAllowance.base_models`"""
     base_model = relationship("ModelPricing")
     """Relationship with the :class:`ModelPricing` model"""
+    __table_args__ = (
+        sa.Index(
+            "ix_token_tracking_sponsored_allowance_base_models_base_model_id",
+            base_model_id,
+        ),
+    )
+    """Table arguments including an index for looking up allowances by :attr:`base_model_id`"""
 
 
 class SponsoredAllowance(Base):
@@ -66,3 +73,11 @@ class SponsoredAllowance(Base):
     """Total credit limit across all users and base models, i.e., maximum sponsored amount"""
     monthly_credit_limit = sa.Column(sa.Integer, nullable=True)
     """Monthly credit limit per user"""
+    __table_args__ = (
+        sa.Index(
+            "ix_token_tracking_sponsored_allowance_sponsor_id_name", sponsor_id, name
+        ),
+        sa.Index("uq_token_tracking_sponsored_allowance_name", name, unique=True),
+    )
+    """Table arguments including an index for filtering by :attr:`sponsor_id` and
+    ordering by :attr:`name`, and a unique index on the :attr:`name` column"""
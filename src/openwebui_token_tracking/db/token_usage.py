@@ -33,3 +33,37 @@ class TokenUsageLog(Base):
     """Number of tokens used in the input/prompt"""
     response_tokens = sa.Column(sa.Integer())
     """Number of tokens generated in the output/response"""
+    cached_tokens = sa.Column(sa.Integer(), nullable=False, server_default="0")
+    """Number of the prompt tokens that were read from the provider's cache, which
+    are charged at a discount (see the ``cached_prompt_token_weight`` setting)"""
+    __table_args__ = (
+        sa.Index(
+            "ix_token_tracking_usage_log_user_allowance_date",
+            user_id,
+            sponsored_allowance_id,
+            log_date,
+            postgresql_include=[
+                "provider",
+                "model_id",
+                "prompt_tokens",
+                "response_tokens",
+                "cached_tokens",
+            ],
+        ),
+        sa.Index(
+            "ix_token_tracking_usage_log_allowance_date",
+            sponsored_allowance_id,
+            log_date,
+            postgresql_include=[
+                "provider",
+                "model_id",
+                "prompt_tokens",
+                "response_tokens",
+                "cached_tokens",
+            ],
+        ),
+    )
+    """Table arguments including indexes for summing a user's or a sponsored
+    allowance's usage over a range of :attr:`log_date`. On PostgreSQL, the
+    indexes include the remaining columns the sums read, so that the sums are
+    answered from the indexes alone."""
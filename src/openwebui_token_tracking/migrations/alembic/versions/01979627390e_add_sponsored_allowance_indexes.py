@@ -0,0 +1,67 @@
+"""add sponsored allowance indexes
+
+Revision ID: 01979627390e
+Revises: f1a2b3c4d5e6
+Create Date: 2026-10-15 09:12:44.318902
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "01979627390e"
+down_revision: Union[str, None] = "f1a2b3c4d5e6"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def index_exists(table_name, index_name):
+    conn = op.get_bind()
+    insp = sa.inspect(conn)
+    indexes = [i["name"] for i in insp.get_indexes(table_name)]
+    return index_name in indexes
+
+
+def upgrade() -> None:
+    if not index_exists(
+        "token_tracking_sponsored_allowance_base_models",
+        "ix_token_tracking_sponsored_allowance_base_models_base_model_id",
+    ):
+        op.create_index(
+            "ix_token_tracking_sponsored_allowance_base_models_base_model_id",
+            "token_tracking_sponsored_allowance_base_models",
+            ["base_model_id"],
+        )
+    # Serves both filtering by sponsor and listing a sponsor's allowances by name
+    if not index_exists(
+        "token_tracking_sponsored_allowance",
+        "ix_token_tracking_sponsored_allowance_sponsor_id_name",
+    ):
+        op.create_index(
+            "ix_token_tracking_sponsored_allowance_sponsor_id_name",
+            "token_tracking_sponsored_allowance",
+            ["sponsor_id", "name"],
+        )
+
+
+def downgrade() -> None:
+    if index_exists(
+        "token_tracking_sponsored_allowance",
+        "ix_token_tracking_sponsored_allowance_sponsor_id_name",
+    ):
+        op.drop_index(
+            "ix_token_tracking_sponsored_allowance_sponsor_id_name",
+            table_name="token_tracking_sponsored_allowance",
+        )
+    if index_exists(
+        "token_tracking_sponsored_allowance_base_models",
+        "ix_token_tracking_sponsored_allowance_base_models_base_model_id",
+    ):
+        op.drop_index(
+            "ix_token_tracking_sponsored_allowance_base_models_base_model_id",
+            table_name="token_tracking_sponsored_allowance_base_models",
+        )
@@ -0,0 +1,89 @@
+"""add sponsored allowance name index
+
+Revision ID: 47c9ff6b2a14
+Revises: 01979627390e
+Create Date: 2026-10-15 10:03:27.550164
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "47c9ff6b2a14"
+down_revision: Union[str, None] = "01979627390e"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def index_exists(table_name, index_name):
+    conn = op.get_bind()
+    insp = sa.inspect(conn)
+    indexes = [i["name"] for i in insp.get_indexes(table_name)]
+    return index_name in indexes
+
+
+def check_unique_names():
+    """Abort the upgrade if sponsored allowances share a name, which the unique
+    index on the name column cannot be created over."""
+    conn = op.get_bind()
+    duplicates = conn.execute(
+        sa.text(
+            "SELECT name, COUNT(*) FROM token_tracking_sponsored_allowance "
+            "GROUP BY name HAVING COUNT(*) > 1 ORDER BY name"
+        )
+    ).all()
+    if duplicates:
+        listing = ", ".join(f"{name!r} ({count}x)" for name, count in duplicates)
+        raise RuntimeError(
+            "Sponsored allowance names must be unique, but these names are used "
+            f"more than once: {listing}. Rename or delete the duplicate sponsored "
+            "allowances, then run the upgrade again."
+        )
+
+
+def upgrade() -> None:
+    check_unique_names()
+    if not index_exists(
+        "token_tracking_sponsored_allowance",
+        "uq_token_tracking_sponsored_allowance_name",
+    ):
+        op.create_index(
+            "uq_token_tracking_sponsored_allowance_name",
+            "token_tracking_sponsored_allowance",
+            ["name"],
+            unique=True,
+        )
+    # The base models table was created without the primary key declared on the
+    # model, so index the pair the model treats as its key
+    if not index_exists(
+        "token_tracking_sponsored_allowance_base_models",
+        "ix_token_tracking_sponsored_allowance_base_models_allowance_model",
+    ):
+        op.create_index(
+            "ix_token_tracking_sponsored_allowance_base_models_allowance_model",
+            "token_tracking_sponsored_allowance_base_models",
+            ["sponsored_allowance_id", "base_model_id"],
+        )
+
+
+def downgrade() -> None:
+    if index_exists(
+        "token_tracking_sponsored_allowance_base_models",
+        "ix_token_tracking_sponsored_allowance_base_models_allowance_model",
+    ):
+        op.drop_index(
+            "ix_token_tracking_sponsored_allowance_base_models_allowance_model",
+            table_name="token_tracking_sponsored_allowance_base_models",
+        )
+    if index_exists(
+        "token_tracking_sponsored_allowance",
+        "uq_token_tracking_sponsored_allowance_name",
+    ):
+        op.drop_index(
+            "uq_token_tracking_sponsored_allowance_name",
+            table_name="token_tracking_sponsored_allowance",
+        )
@@ -0,0 +1,75 @@
+"""add token usage log indexes
+
+Revision ID: b52e0f9a7d13
+Revises: c3f8a1e5d092
+Create Date: 2026-10-15 15:02:41.227391
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b52e0f9a7d13"
+down_revision: Union[str, None] = "c3f8a1e5d092"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def index_exists(table_name, index_name):
+    conn = op.get_bind()
+    insp = sa.inspect(conn)
+    indexes = [i["name"] for i in insp.get_indexes(table_name)]
+    return index_name in indexes
+
+
+# Columns read by the credit sums besides the filtered ones; PostgreSQL stores
+# them in the index so that the sums are answered by index-only scans
+_INCLUDED_COLUMNS = [
+    "provider",
+    "model_id",
+    "prompt_tokens",
+    "response_tokens",
+    "cached_tokens",
+]
+
+
+def upgrade() -> None:
+    if not index_exists(
+        "token_tracking_usage_log", "ix_token_tracking_usage_log_user_allowance_date"
+    ):
+        op.create_index(
+            "ix_token_tracking_usage_log_user_allowance_date",
+            "token_tracking_usage_log",
+            ["user_id", "sponsored_allowance_id", "log_date"],
+            postgresql_include=_INCLUDED_COLUMNS,
+        )
+    if not index_exists(
+        "token_tracking_usage_log", "ix_token_tracking_usage_log_allowance_date"
+    ):
+        op.create_index(
+            "ix_token_tracking_usage_log_allowance_date",
+            "token_tracking_usage_log",
+            ["sponsored_allowance_id", "log_date"],
+            postgresql_include=_INCLUDED_COLUMNS,
+        )
+
+
+def downgrade() -> None:
+    if index_exists(
+        "token_tracking_usage_log", "ix_token_tracking_usage_log_allowance_date"
+    ):
+        op.drop_index(
+            "ix_token_tracking_usage_log_allowance_date",
+            table_name="token_tracking_usage_log",
+        )
+    if index_exists(
+        "token_tracking_usage_log", "ix_token_tracking_usage_log_user_allowance_date"
+    ):
+        op.drop_index(
+            "ix_token_tracking_usage_log_user_allowance_date",
+            table_name="token_tracking_usage_log",
+        )
@@ -0,0 +1,42 @@
+"""add token usage log cached tokens
+
+Revision ID: c3f8a1e5d092
+Revises: 47c9ff6b2a14
+Create Date: 2026-10-15 17:05:36.172840
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c3f8a1e5d092"
+down_revision: Union[str, None] = "47c9ff6b2a14"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def column_exists(table_name, column_name):
+    conn = op.get_bind()
+    insp = sa.inspect(conn)
+    columns = [c["name"] for c in insp.get_columns(table_name)]
+    return column_name in columns
+
+
+def upgrade() -> None:
+    if column_exists("token_tracking_usage_log", "cached_tokens"):
+        return
+    with op.batch_alter_table("token_tracking_usage_log") as batch_op:
+        batch_op.add_column(
+            sa.Column(
+                "cached_tokens", sa.Integer(), nullable=False, server_default="0"
+            ),
+        )
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("token_tracking_usage_log") as batch_op:
+        batch_op.drop_column("cached_tokens")
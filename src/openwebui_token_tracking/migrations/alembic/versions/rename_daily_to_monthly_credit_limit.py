@@ -19,11 +19,32 @@ branch_labels: Union[str, Sequence[str], None] = None
 depends_on: Union[str, Sequence[str], None] = None
 
 
+# Expression for the schema that unqualified table names resolve to
+_CURRENT_SCHEMA = {
+    "postgresql": "current_schema()",
+    "mysql": "DATABASE()",
+    "mariadb": "DATABASE()",
+}
+
+
 def column_exists(table_name, column_name):
     conn = op.get_bind()
-    insp = sa.inspect(conn)
-    columns = [c["name"] for c in insp.get_columns(table_name)]
-    return column_name in columns
+    current_schema = _CURRENT_SCHEMA.get(conn.dialect.name)
+    if current_schema is None:
+        # E.g., SQLite has no information_schema, so reflect the table instead
+        insp = sa.inspect(conn)
+        columns = [c["name"] for c in insp.get_columns(table_name)]
+        return column_name in columns
+
+    query = sa.text(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_name = :table_name AND column_name = :column_name "
+        f"AND table_schema = {current_schema}"
+    )
+    row = conn.execute(
+        query, {"table_name": table_name, "column_name": column_name}
+    ).first()
+    return row is not None
 
 
 def upgrade() -> None:
@@ -1,5 +1,6 @@
-from openwebui_token_tracking.db import init_db, ModelPricing
+from openwebui_token_tracking.db import get_engine, ModelPricing
 from openwebui_token_tracking.models import ModelPricingSchema
+from openwebui_token_tracking.tracking import TokenTracker
 from sqlalchemy.orm import Session
 
 
@@ -18,7 +19,7 @@ def get_model_pricing(
     :return: List of dictionaries containing model pricing information
     :rtype: list[dict]
     """
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         query = session.query(ModelPricing)
 
@@ -53,7 +54,7 @@ def list_model_pricing(database_url: str, provider: str = None) -> list[dict]:
     :return: List of dictionaries containing model pricing information
     :rtype: list[dict]
     """
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         query = session.query(ModelPricing)
         if provider:
@@ -82,11 +83,12 @@ def add_model_pricing(database_url: str, model_pricing: list[ModelPricingSchema]
     :type models: list[ModelPricing], optional
     """
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         for model in model_pricing:
             session.add(ModelPricing(**model.model_dump()))
         session.commit()
+    TokenTracker.shared(database_url).invalidate_models_cache()
 
 
 def update_model_pricing(
@@ -119,7 +121,7 @@ def update_model_pricing(
     if not filtered_updates:
         return False
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         try:
             # Find the specific model
@@ -135,6 +137,7 @@ def update_model_pricing(
             for key, value in filtered_updates.items():
                 setattr(model, key, value)
             session.commit()
+            TokenTracker.shared(database_url).invalidate_models_cache()
             return True
 
         except Exception as e:
@@ -174,7 +177,7 @@ def upsert_model_pricing(
     :return: True if operation was successful
     :rtype: bool
     """
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         try:
             # Try to find existing record
@@ -205,6 +208,7 @@ def upsert_model_pricing(
                 session.add(model)
 
             session.commit()
+            TokenTracker.shared(database_url).invalidate_models_cache()
             return True
 
         except Exception as e:
@@ -227,7 +231,7 @@ def delete_model_pricing(
     :return: True if deletion was successful, False if model not found
     :rtype: bool
     """
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         try:
             query = session.query(ModelPricing).filter(ModelPricing.id == model_id)
@@ -237,6 +241,7 @@ def delete_model_pricing(
             result = query.delete()
 
             session.commit()
+            TokenTracker.shared(database_url).invalidate_models_cache()
             # Return True if a row was deleted, False otherwise
             return result > 0
 
@@ -1,11 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import os
-import requests
 import json
 from pydantic import BaseModel, Field
 from typing import List, Generator, Any, Tuple
-from openwebui_token_tracking.utils import pop_system_message
+from openwebui_token_tracking.utils import (
+    dump_json_body,
+    iter_sse_lines,
+    pop_system_message,
+)
 from .base_tracked_pipe import BaseTrackedPipe, RequestError, TokenCount
 
+logger = logging.getLogger(__name__)
+
+
+_MAX_IMAGES_PER_REQUEST = 100
+_MAX_TOTAL_IMAGE_BYTES = 100 * 1024 * 1024  # 100MB across all images
+
+
+# Handlers for the server-sent events of the Messages streaming API. Each handler
+# receives the parsed event and the request's TokenCount and returns the text
+# chunks to yield, or None to end the stream.
+
+
+def _ignore_event(data: dict, tokens: TokenCount) -> tuple:
+    return ()
+
+
+def _content_block_start(data: dict, tokens: TokenCount) -> tuple:
+    return (data["content_block"]["text"],)
+
+
+def _content_block_delta(data: dict, tokens: TokenCount) -> tuple:
+    return (data["delta"]["text"],)
+
+
+def _message_stop(data: dict, tokens: TokenCount) -> None:
+    return None
+
+
+def _message_start(data: dict, tokens: TokenCount) -> tuple:
+    tokens.prompt_tokens = data["message"]["usage"]["input_tokens"]
+    return ()
+
+
+def _message_delta(data: dict, tokens: TokenCount) -> tuple:
+    tokens.response_tokens = data["usage"]["output_tokens"]
+    return ()
+
+
+def _message(data: dict, tokens: TokenCount) -> list:
+    return [
+        content["text"]
+        for content in data.get("content", [])
+        if content["type"] == "text"
+    ]
+
+
+_STREAM_EVENT_HANDLERS = {
+    "content_block_start": _content_block_start,
+    "content_block_delta": _content_block_delta,
+    "message_stop": _message_stop,
+    "message_start": _message_start,
+    "message_delta": _message_delta,
+    "message": _message,
+}
+
 
 class AnthropicTrackedPipe(BaseTrackedPipe):
     """
@@ -23,8 +83,15 @@ class AnthropicTrackedPipe(BaseTrackedPipe):
             default="",
             description="API key for authenticating requests to the Anthropic API.",
         )
+        CACHE_ENABLED: bool = Field(
+            default=False,
+            description="Replay responses to identical non-streaming requests with a temperature of 0 for an hour.",
+        )
         DEBUG: bool = Field(default=False)
 
+    TIMEOUT = (3.05, 60)
+    """Connect and read timeouts of API requests in seconds"""
+
     def __init__(self):
         """
         Initialize the Anthropic pipe with API endpoint and configuration.
@@ -94,43 +161,45 @@ class AnthropicTrackedPipe(BaseTrackedPipe):
         tokens = TokenCount()
 
         def generate_stream():
-            with requests.post(
-                self.url, headers=headers, json=payload, stream=True, timeout=(3.05, 60)
+            with self._session.post(
+                self.url,
+                headers=headers,
+                data=dump_json_body(payload),
+                stream=True,
+                timeout=self.TIMEOUT,
             ) as response:
                 if response.status_code != 200:
                     raise RequestError(
                         f"HTTP Error {response.status_code}: {response.text}"
                     )
 
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode("utf-8")
-                        if line.startswith("data: "):
-                            try:
-                                data = json.loads(line[6:])
-                                if data["type"] == "content_block_start":
-                                    yield data["content_block"]["text"]
-                                elif data["type"] == "content_block_delta":
-                                    yield data["delta"]["text"]
-                                elif data["type"] == "message_stop":
-                                    break
-                                elif data["type"] == "message_start":
-                                    tokens.prompt_tokens = data["message"]["usage"][
-                                        "input_tokens"
-                                    ]
-                                elif data["type"] == "message_delta":
-                                    tokens.response_tokens = data["usage"][
-                                        "output_tokens"
-                                    ]
-                                elif data["type"] == "message":
-                                    for content in data.get("content", []):
-                                        if content["type"] == "text":
-                                            yield content["text"]
-                            except json.JSONDecodeError:
-                                print(f"Failed to parse JSON: {line}")
-                            except KeyError as e:
-                                print(f"Unexpected data structure: {e}")
-                                print(f"Full data: {data}")
+                # Lines are kept as bytes: json.loads decodes UTF-8 itself, so
+                # there is no need to build an intermediate str per event.
+                # Names used per line are bound to locals once per stream.
+                loads = json.loads
+                get_handler = _STREAM_EVENT_HANDLERS.get
+                for line in iter_sse_lines(response):
+                    if not line.startswith(b"data: "):
+                        continue
+                    try:
+                        data = loads(line[6:])
+                        texts = get_handler(data["type"], _ignore_event)(data, tokens)
+                    except json.JSONDecodeError:
+                        logger.debug("Failed to parse JSON: %r", line)
+                        continue
+                    except KeyError as e:
+                        logger.debug(
+                            "Unexpected data structure: %s\nFull data: %s", e, data
+                        )
+                        continue
+                    if texts is None:
+                        # Read the rest of the body (only the end of the chunked
+                        # encoding follows message_stop) so the connection goes
+                        # back to the pool instead of being closed
+                        for _ in response.iter_content(chunk_size=None):
+                            pass
+                        break
+                    yield from texts
 
         return tokens, generate_stream()
 
@@ -148,8 +217,11 @@ class AnthropicTrackedPipe(BaseTrackedPipe):
         :rtype: Tuple[TokenCount, Any]
         :raises RequestError: If the API request fails
         """
-        response = requests.post(
-            self.url, headers=headers, json=payload, timeout=(3.05, 60)
+        response = self._session.post(
+            self.url,
+            headers=headers,
+            data=dump_json_body(payload),
+            timeout=self.TIMEOUT,
         )
         if response.status_code != 200:
             raise RequestError(f"HTTP Error {response.status_code}: {response.text}")
@@ -168,6 +240,7 @@ class AnthropicTrackedPipe(BaseTrackedPipe):
         processed_messages = []
         image_count = 0
         total_image_size = 0
+        image_urls = []
 
         for message in messages:
             processed_content = []
@@ -176,16 +249,20 @@ class AnthropicTrackedPipe(BaseTrackedPipe):
                     if item["type"] == "text":
                         processed_content.append({"type": "text", "text": item["text"]})
                     elif item["type"] == "image_url":
-                        if image_count >= 100:
+                        if image_count >= _MAX_IMAGES_PER_REQUEST:
                             raise ValueError(
                                 "Maximum of 100 images per API call exceeded"
                             )
                         processed_image = self._process_image(item)
+                        # Only base64 images carry a size, which is computed once
+                        # by _process_image and must not be sent to the API
+                        image_size = processed_image.pop("_decoded_size", None)
                         processed_content.append(processed_image)
-                        if processed_image["source"]["type"] == "base64":
-                            image_size = len(processed_image["source"]["data"]) * 3 / 4
+                        if processed_image["source"]["type"] == "url":
+                            image_urls.append(processed_image["source"]["url"])
+                        elif image_size is not None:
                             total_image_size += image_size
-                            if total_image_size > 100 * 1024 * 1024:
+                            if total_image_size > _MAX_TOTAL_IMAGE_BYTES:
                                 raise ValueError(
                                     "Total size of images exceeds 100 MB limit"
                                 )
@@ -199,14 +276,26 @@ class AnthropicTrackedPipe(BaseTrackedPipe):
                 {"role": message["role"], "content": processed_content}
             )
 
+        # Validate remote images concurrently rather than one round trip at a time
+        if len(image_urls) == 1:
+            self._check_image_url(image_urls[0])
+        elif image_urls:
+            with ThreadPoolExecutor(max_workers=min(16, len(image_urls))) as executor:
+                # Consuming the results re-raises the first validation error
+                list(executor.map(self._check_image_url, image_urls))
+
         return processed_messages
 
     def _process_image(self, image_data: dict) -> dict:
-        """Process image data with size validation."""
+        """Process image data with size validation.
+
+        Images given by URL are validated separately, see :meth:`_check_image_url`.
+        """
         if image_data["image_url"]["url"].startswith("data:image"):
             mime_type, base64_data = image_data["image_url"]["url"].split(",", 1)
             media_type = mime_type.split(":")[1].split(";")[0]
-            image_size = len(base64_data) * 3 / 4
+            # Approximate decoded size; 4 base64 characters encode 3 bytes
+            image_size = (len(base64_data) * 3) >> 2
             if image_size > self.MAX_IMAGE_SIZE:
                 raise ValueError(
                     f"Image size exceeds 5MB limit: {image_size / (1024 * 1024):.2f}MB"
@@ -218,16 +307,25 @@ class AnthropicTrackedPipe(BaseTrackedPipe):
                     "media_type": media_type,
                     "data": base64_data,
                 },
+                "_decoded_size": image_size,
             }
         else:
             url = image_data["image_url"]["url"]
-            response = requests.head(url, allow_redirects=True)
-            content_length = int(response.headers.get("content-length", 0))
-            if content_length > self.MAX_IMAGE_SIZE:
-                raise ValueError(
-                    f"Image at URL exceeds 5MB limit: {content_length / (1024 * 1024):.2f}MB"
-                )
             return {
                 "type": "image",
                 "source": {"type": "url", "url": url},
             }
+
+    def _check_image_url(self, url: str):
+        """Check the size of a remote image with a HEAD request.
+
+        :param url: URL of the image
+        :type url: str
+        :raises ValueError: If the image exceeds the size limit
+        """
+        response = self._session.head(url, allow_redirects=True)
+        content_length = int(response.headers.get("content-length", 0))
+        if content_length > self.MAX_IMAGE_SIZE:
+            raise ValueError(
+                f"Image at URL exceeds 5MB limit: {content_length / (1024 * 1024):.2f}MB"
+            )
@@ -1,10 +1,20 @@
+import hashlib
+import logging
 import os
 import requests
 import json
 from pydantic import BaseModel, Field
 from typing import Generator, Any, Tuple
+from openwebui_token_tracking.utils import dump_json_body, iter_sse_lines
 from .base_tracked_pipe import BaseTrackedPipe, RequestError, TokenCount
 
+logger = logging.getLogger(__name__)
+
+
+def _end_user_id(user_id: str) -> str:
+    """Pseudonymize an Open WebUI user ID for the API's ``user`` parameter"""
+    return hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:16]
+
 
 class AzureOpenAITrackedPipe(BaseTrackedPipe):
     """
@@ -38,8 +48,21 @@ class AzureOpenAITrackedPipe(BaseTrackedPipe):
         PROVIDER: str = Field(
             default="azure_openai", description="Name of the model provider."
         )
+        CACHE_ENABLED: bool = Field(
+            default=False,
+            description="Replay responses to identical non-streaming requests with a temperature of 0 for an hour.",
+        )
+        MAX_INPUT_TOKENS: int = Field(
+            default=0,
+            description="Reject requests whose text is estimated to exceed this many tokens without sending them to Azure (0 disables the check).",
+        )
         DEBUG: bool = Field(default=False)
 
+    TIMEOUT = (3.05, 60)
+    """Connect and read timeouts of API requests in seconds"""
+    STREAM_OPTIONS = {"include_usage": True}
+    """Options of streaming requests; the final chunk reports the token usage"""
+
     def __init__(self):
         """Initialize the Azure OpenAI pipe with API endpoint and configuration."""
         self.valves = self.Valves(
@@ -144,24 +167,28 @@ class AzureOpenAITrackedPipe(BaseTrackedPipe):
         :raises RequestError: If the API request fails
         """
         tokens = TokenCount()
-        deployment_name = payload.pop("deployment_name")
+        # The URL is built per request rather than stored on the pipe, which is
+        # shared by all users' concurrent requests
+        url = self._build_url(payload.pop("deployment_name"))
+        # The payload is the pipe's own shallow copy of the body (see _payload),
+        # so it can be amended in place
+        payload["stream_options"] = self.STREAM_OPTIONS
 
         def generate_stream():
             try:
-                self.url = self._build_url(deployment_name)
-                stream_payload = {**payload, "stream_options": {"include_usage": True}}
-
-                if self.valves.DEBUG:
-                    print(f"Azure OpenAI Request URL: {self.url}")
-                    print(f"Azure OpenAI Headers: {headers}")
-                    print(f"Azure OpenAI Payload: {stream_payload}")
-
-                with requests.post(
-                    url=self.url,
+                self._debug(
+                    "Azure OpenAI request:\n  URL: %s\n  Headers: %s\n  Payload: %s",
+                    url,
+                    headers,
+                    payload,
+                )
+
+                with self._session.post(
+                    url=url,
                     headers=headers,
-                    json=stream_payload,
+                    data=dump_json_body(payload),
                     stream=True,
-                    timeout=(3.05, 60),
+                    timeout=self.TIMEOUT,
                 ) as response:
                     if response.status_code != 200:
                         error_text = response.text
@@ -169,41 +196,42 @@ class AzureOpenAITrackedPipe(BaseTrackedPipe):
                             f"HTTP Error {response.status_code}: {error_text}"
                         )
 
-                    for line in response.iter_lines():
-                        if line:
-                            line = line.decode("utf-8")
-                            if line.startswith("data: "):
-                                try:
-                                    # Normalize the line (remove prefix and potential trailing newline)
-                                    json_str = line[6:].strip()
-                                    if json_str == "[DONE]":
-                                        break
-                                        
-                                    data = json.loads(json_str)
-                                    
-                                    # Track token usage
-                                    if data.get("usage", None):
-                                        tokens.prompt_tokens = data["usage"].get(
-                                            "prompt_tokens", 0
-                                        )
-                                        tokens.response_tokens = data["usage"].get(
-                                            "completion_tokens", 0
-                                        )
-
-                                    # Extract and yield content
-                                    choices = data.get("choices", [])
-                                    if choices:
-                                        delta = choices[0].get("delta", {})
-                                        content = delta.get("content")
-                                        if content:
-                                            yield content
-                                            
-                                except json.JSONDecodeError:
-                                    if self.valves.DEBUG:
-                                        print(f"Failed to parse JSON: {line}")
-                                except Exception as e:
-                                    if self.valves.DEBUG:
-                                        print(f"Error processing chunk: {e}")
+                    for line in iter_sse_lines(response):
+                        if line.startswith(b"data: "):
+                            try:
+                                # Normalize the line (remove prefix and potential trailing newline)
+                                json_str = line[6:].strip()
+                                if json_str == b"[DONE]":
+                                    # Read the rest of the body so the
+                                    # connection goes back to the session's
+                                    # pool instead of being closed
+                                    for _ in response.iter_content(chunk_size=None):
+                                        pass
+                                    break
+
+                                data = json.loads(json_str)
+
+                                # Track token usage
+                                if data.get("usage", None):
+                                    tokens.prompt_tokens = data["usage"].get(
+                                        "prompt_tokens", 0
+                                    )
+                                    tokens.response_tokens = data["usage"].get(
+                                        "completion_tokens", 0
+                                    )
+
+                                # Extract and yield content
+                                choices = data.get("choices", [])
+                                if choices:
+                                    delta = choices[0].get("delta", {})
+                                    content = delta.get("content")
+                                    if content:
+                                        yield content
+
+                            except json.JSONDecodeError:
+                                self._debug("Failed to parse JSON: %r", line)
+                            except Exception as e:
+                                self._debug("Error processing chunk: %s", e)
             except requests.exceptions.RequestException as e:
                 error_msg = str(e).encode('ascii', 'ignore').decode('ascii')
                 raise RequestError(f"Request failed: {error_msg}")
@@ -228,23 +256,29 @@ class AzureOpenAITrackedPipe(BaseTrackedPipe):
         :raises RequestError: If the API request fails
         """
         try:
-            deployment_name = payload.pop("deployment_name")
-            self.url = self._build_url(deployment_name)
+            url = self._build_url(payload.pop("deployment_name"))
 
-            if self.valves.DEBUG:
-                print(f"Azure OpenAI Request URL: {self.url}")
-                print(f"Azure OpenAI Headers: {headers}")
-                print(f"Azure OpenAI Payload: {payload}")
+            self._debug(
+                "Azure OpenAI request:\n  URL: %s\n  Headers: %s\n  Payload: %s",
+                url,
+                headers,
+                payload,
+            )
 
-            response = requests.post(
-                self.url, headers=headers, json=payload, timeout=(3.05, 60)
+            response = self._session.post(
+                url,
+                headers=headers,
+                data=dump_json_body(payload),
+                timeout=self.TIMEOUT,
             )
 
             if response.status_code != 200:
                 error_text = response.text
                 raise RequestError(f"HTTP Error {response.status_code}: {error_text}")
 
-            res = response.json()
+            # Parsed from the raw bytes, which json decodes itself, instead of
+            # building the response text first
+            res = json.loads(response.content)
             tokens = TokenCount()
             tokens.prompt_tokens = res["usage"]["prompt_tokens"]
             tokens.response_tokens = res["usage"]["completion_tokens"]
@@ -261,6 +295,11 @@ class AzureOpenAITrackedPipe(BaseTrackedPipe):
         self.provider = self.valves.PROVIDER
         return super().pipes()
 
-    def pipe(self, body, __user__, __metadata__):
+    async def pipe(self, body, __user__, __metadata__):
         self.provider = self.valves.PROVIDER
-        return super().pipe(body, __user__, __metadata__)
+        if "user" not in body:
+            # A stable end-user identifier lets Azure route a user's requests to
+            # the same prompt cache, so that repeated prefixes (system prompt,
+            # tools, earlier turns) are billed and processed as cached tokens
+            body = {**body, "user": _end_user_id(__user__["id"])}
+        return await super().pipe(body, __user__, __metadata__)
@@ -12,13 +12,21 @@ Classes:
 """
 
 from abc import ABC, abstractmethod
+import asyncio
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import hashlib
+import json
 import logging
 import os
 import re
-from typing import Any, List, Union, Generator, Iterator, Tuple
+import threading
+from typing import Any, AsyncGenerator, List, Union, Generator, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from openwebui_token_tracking import TokenTracker
 from openwebui_token_tracking.tracking import (
@@ -26,20 +34,81 @@ from openwebui_token_tracking.tracking import (
     MonthlyTokenLimitExceededError,
     TotalTokenLimitExceededError,
 )
+from openwebui_token_tracking.utils import TTLCache
 
 logger = logging.getLogger(__name__)
 
 
+_REMAINING_CREDITS_CACHE = TTLCache(ttl=30, maxsize=1024)
+"""Remaining credits keyed by user ID and sponsored allowance name. Shared by all
+pipes so that usage logged through one provider invalidates the limit checks of
+the others."""
+
+_BALANCE_CACHE = TTLCache(ttl=5)
+"""Recently displayed ``(credits_left, max_credits)`` keyed by user ID, for the
+credit balance action. Kept here so that logged usage invalidates it too."""
+
+
+_USAGE_LOG_EXECUTOR = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="token-usage-log"
+)
+"""Writes token usage off the response path, in submission order. Pending writes
+are completed before the interpreter exits."""
+
+_STREAM_EXECUTOR = ThreadPoolExecutor(
+    max_workers=64, thread_name_prefix="token-tracking-stream"
+)
+"""Reads the providers' blocking streaming responses, one thread per response for
+as long as it streams. Sized like the pipes' connection pools. Keeping the streams
+off the event loop's default executor leaves that free for the limit checks and
+payloads of new requests."""
+
+_PENDING_USAGE_LOGS: collections.deque = collections.deque()
+"""Token usage waiting to be written by :data:`_USAGE_LOG_EXECUTOR`, as pairs of
+the tracker to write it with and the usage entry"""
+
+
+def _write_pending_usage_logs():
+    """Write all pending token usage, in one transaction per tracker.
+
+    Usage logged while an earlier write is in progress is thereby written
+    together. If a batch fails, its entries are retried one by one, so that one
+    bad entry does not lose the usage of other requests.
+    """
+    batches = {}
+    while _PENDING_USAGE_LOGS:
+        tracker, entry = _PENDING_USAGE_LOGS.popleft()
+        batches.setdefault(tracker, []).append(entry)
+
+    for tracker, entries in batches.items():
+        try:
+            tracker.log_token_usage_bulk(entries)
+        except Exception:
+            for entry in entries:
+                try:
+                    tracker.log_token_usage_bulk([entry])
+                except Exception:
+                    logger.exception(
+                        "Failed to log token usage for %s", entry["user"].get("id")
+                    )
+        finally:
+            for entry in entries:
+                _REMAINING_CREDITS_CACHE.pop(
+                    (entry["user"]["id"], entry["sponsored_allowance_name"])
+                )
+                _BALANCE_CACHE.pop(entry["user"]["id"])
+
+
 def _time_to_month_end():
-    from calendar import monthrange
-    now = datetime.datetime.now()
-    current_year = now.year
-    current_month = now.month
-    last_day = monthrange(current_year, current_month)[1]
-    
+    # Monthly usage is counted in UTC months
+    now = datetime.datetime.now(datetime.UTC)
+    next_month_first_day = datetime.datetime(
+        now.year + (now.month == 12), now.month % 12 + 1, 1, tzinfo=datetime.UTC
+    )
+
     # Calculate end of month datetime
-    end_of_month = datetime.datetime(current_year, current_month, last_day, 23, 59, 59)
-    
+    end_of_month = next_month_first_day - datetime.timedelta(seconds=1)
+
     # Calculate time difference
     time_to_month_end = end_of_month - now
     return time_to_month_end
@@ -50,14 +119,38 @@ class RequestError(Exception):
 
 
 class TokenCount:
+    __slots__ = ("prompt_tokens", "response_tokens", "cached_tokens")
+
     def __init__(self):
         self.prompt_tokens = 0
         self.response_tokens = 0
+        # Number of the prompt tokens that were read from the provider's cache
+        self.cached_tokens = 0
+
+
+def _estimate_text_tokens(messages: List[dict]) -> int:
+    """A helper function roughly estimating the number of tokens in the text of
+    Open WebUI chat messages, assuming four characters per token"""
+    characters = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            characters += len(content)
+        elif isinstance(content, list):
+            characters += sum(
+                len(item.get("text", ""))
+                for item in content
+                if item.get("type") == "text"
+            )
+    return characters // 4
+
+
+_CAMEL_CASE_WORD = re.compile("[A-Z][^A-Z]*")
 
 
 def _make_mermaid_error_message(type: str, message: str) -> str:
     """A helper function creating a boxed error message with Mermaid syntax"""
-    header = " ".join(re.findall("[A-Z][^A-Z]*", type))
+    header = " ".join(_CAMEL_CASE_WORD.findall(type))
     header = header.replace('"', "'")
 
     return f"""```mermaid
@@ -86,13 +179,41 @@ class BaseTrackedPipe(ABC):
 
     DATABASE_URL_ENV = "DATABASE_URL"
     MODEL_ID_PREFIX = "."
+    RESPONSE_CACHE_TTL = 3600
+    """Seconds for which cached non-streaming responses are replayed"""
 
     def __init__(self, provider, url):
         self.provider = provider
         self.url = url
         self.type = "manifold"
         self.valves = self.Valves()
-        self.token_tracker = TokenTracker(os.environ[BaseTrackedPipe.DATABASE_URL_ENV])
+        self.token_tracker = TokenTracker.shared(
+            os.environ[BaseTrackedPipe.DATABASE_URL_ENV]
+        )
+        # Keep connections to the API alive across requests instead of
+        # repeating the TCP and TLS handshakes for every message
+        self._session = requests.Session()
+        self._session.mount(
+            "https://", HTTPAdapter(pool_connections=16, pool_maxsize=64)
+        )
+        # Token counts and responses of deterministic non-streaming requests,
+        # keyed by a digest of the request (see _response_cache_key)
+        self._response_cache = TTLCache(ttl=self.RESPONSE_CACHE_TTL, maxsize=256)
+
+    def _debug(self, msg: str, *args):
+        """
+        Log a message of the pipe's debug output if its DEBUG valve is on.
+
+        The valve is checked per call instead of setting a logger's level, since
+        loggers are shared by all pipes while each pipe has its own valves. The
+        message is logged at INFO level, so it shows without changing the logging
+        configuration.
+
+        :param msg: The message, formatted with ``args`` only if it is logged
+        :type msg: str
+        """
+        if self.valves.DEBUG:
+            logging.getLogger(type(self).__module__).info(msg, *args)
 
     def _check_limits(
         self, model_id: str, user: dict, sponsored_allowance_name: str = None
@@ -110,14 +231,18 @@ class BaseTrackedPipe(ABC):
         :return: True if within limits
         :rtype: bool
         """
-        if not self.token_tracker.is_paid(model_id):
-            return True
-
-        monthly_credits_remaining, total_sponsored_credits_remaining = (
-            self.token_tracker.remaining_credits(
-                user, sponsored_allowance_name=sponsored_allowance_name
+        cache_key = (user["id"], sponsored_allowance_name)
+        remaining = _REMAINING_CREDITS_CACHE.get(cache_key)
+        if remaining is None:
+            is_paid, *remaining = self.token_tracker.check_limits(
+                model_id, user, sponsored_allowance_name=sponsored_allowance_name
             )
-        )
+            if not is_paid:
+                return True
+            _REMAINING_CREDITS_CACHE.set(cache_key, tuple(remaining))
+        elif not self.token_tracker.is_paid(model_id):
+            return True
+        monthly_credits_remaining, total_sponsored_credits_remaining = remaining
 
         if (
             total_sponsored_credits_remaining is not None
@@ -217,6 +342,39 @@ f"\nYour usage will reset in {_time_to_month_end()}.\n"
         """
         pass
 
+    def _response_cache_key(self, model_id: str, body: dict) -> str | None:
+        """
+        Get the key under which the response to a non-streaming request is cached.
+
+        The key is derived from the request as Open WebUI sends it, before it is
+        formatted for the provider, so it is the same for every provider. Only
+        requests with a temperature of 0 are cached, and only if the pipe's valves
+        enable it (``CACHE_ENABLED``).
+
+        :param model_id: The ID of the model being accessed
+        :type model_id: str
+        :param body: The request body containing the prompt and other parameters
+        :type body: dict
+        :return: Hex digest identifying the request, or None if it is not cacheable
+        :rtype: str | None
+        """
+        if not getattr(self.valves, "CACHE_ENABLED", False):
+            return None
+        if body.get("temperature") != 0:
+            return None
+        request = json.dumps(
+            {
+                "provider": self.provider,
+                "model": model_id,
+                "messages": body.get("messages"),
+                "temperature": body.get("temperature"),
+                "max_tokens": body.get("max_tokens"),
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
     def get_models(self) -> List[dict]:
         """
         Get a list of available models for this provider.
@@ -248,9 +406,9 @@ f"\nYour usage will reset in {_time_to_month_end()}.\n"
         """
         return self.get_models()
 
-    def pipe(
+    async def pipe(
         self, body: dict, __user__: dict, __metadata__: dict
-    ) -> Union[str, Generator, Iterator]:
+    ) -> Union[str, Any, AsyncGenerator]:
         """
         Process an incoming request through the appropriate model pipeline.
 
@@ -266,8 +424,9 @@ f"\nYour usage will reset in {_time_to_month_end()}.\n"
         :type __user__: dict
         :param __metadata__: Additional metadata for the request
         :type __metadata__: dict
-        :return: Either a string response or a generator for streaming responses
-        :rtype: Union[str, Generator, Iterator]
+        :return: Either the response or an asynchronous generator for streaming
+            responses
+        :rtype: Union[str, Any, AsyncGenerator]
         :raises TokenLimitExceededError: If user has exceeded their token limit
         :raises RequestError: If the API request fails
         """
@@ -285,22 +444,36 @@ f"\nYour usage will reset in {_time_to_month_end()}.\n"
         if model_info and model_info.get("base_model_id", None) is not None:
             # Check if Workspace Model name follows sponsored allowance
             # naming scheme and extract sponsored allowance name
-            if "---" in model_info["id"]:
-                sponsored_allowance_name, *_ = model_info["id"].split("---")
-            model_id = model_info["base_model_id"].replace(
-                self.provider + BaseTrackedPipe.MODEL_ID_PREFIX, "", 1
-            )
+            head, separator, _ = model_info["id"].partition("---")
+            if separator:
+                sponsored_allowance_name = head
+            model_id = model_info["base_model_id"]
         else:
-            model_id = model["id"].replace(
-                self.provider + BaseTrackedPipe.MODEL_ID_PREFIX, "", 1
-            )
+            model_id = model["id"]
+        prefix = self.provider + BaseTrackedPipe.MODEL_ID_PREFIX
+        if model_id.startswith(prefix):
+            model_id = model_id[len(prefix) :]
+
+        # Reject prompts that cannot fit the model before they use up the user's
+        # time, bandwidth, and API quota (only if the pipe's valves set a limit)
+        max_input_tokens = getattr(self.valves, "MAX_INPUT_TOKENS", 0)
+        if max_input_tokens:
+            estimated_tokens = _estimate_text_tokens(body.get("messages", []))
+            if estimated_tokens > max_input_tokens:
+                return _make_mermaid_error_message(
+                    type="InputTooLongError",
+                    message=f"Your conversation is too long for this model (about "
+                    f"{estimated_tokens} tokens, the limit is {max_input_tokens}).\n"
+                    "Please start a new chat or shorten your message.",
+                )
 
         try:
             # This used to raise an exception that is displayed in the UI as an error
             # message. At some point this broke upstream, so we will need to wait
             # until it gets fixed. Until then, we return just a message so the user
             # at least gets some feedback.
-            self._check_limits(
+            await asyncio.to_thread(
+                self._check_limits,
                 model_id=model_id,
                 user=__user__,
                 sponsored_allowance_name=sponsored_allowance_name,
@@ -308,18 +481,37 @@ f"\nYour usage will reset in {_time_to_month_end()}.\n"
         except TokenLimitExceededError as e:
             return _make_mermaid_error_message(type=type(e).__name__, message=str(e))
 
-        if self.valves.DEBUG:
-            print("Incoming body:", str(body))
+        self._debug("Incoming body: %s", body)
+
+        # Replay the response to an identical deterministic request without
+        # formatting or sending it again (only if the pipe's valves enable it)
+        cache_key = None
+        if not body.get("stream", False):
+            cache_key = self._response_cache_key(model_id, body)
+            cached = None if cache_key is None else self._response_cache.get(cache_key)
+            if cached is not None:
+                # Replayed responses are billed like fresh ones
+                tokens, response = cached
+                self._log_token_usage(
+                    model_id,
+                    __user__,
+                    tokens,
+                    sponsored_allowance_name=sponsored_allowance_name,
+                )
+                return response
 
         headers = self._headers()
 
-        payload = self._payload(model_id=model_id, body=body)
+        # Building the payload may involve I/O (e.g., checking image URLs)
+        payload = await asyncio.to_thread(self._payload, model_id=model_id, body=body)
 
-        if self.valves.DEBUG:
-            print(f"{self.provider} API request:")
-            print("  Model:", model_id)
-            print("  Contents:", payload)
-            print("  Stream:", body.get("stream"))
+        self._debug(
+            "%s API request:\n  Model: %s\n  Contents: %s\n  Stream: %s",
+            self.provider,
+            model_id,
+            payload,
+            body.get("stream"),
+        )
 
         try:
             if body.get("stream", False):
@@ -331,28 +523,86 @@ f"\nYour usage will reset in {_time_to_month_end()}.\n"
                     sponsored_allowance_name=sponsored_allowance_name,
                 )
             else:
-                return self.non_stream_response(
+                return await asyncio.to_thread(
+                    self.non_stream_response,
                     headers,
                     payload,
                     model_id,
                     __user__,
                     sponsored_allowance_name=sponsored_allowance_name,
+                    cache_key=cache_key,
                 )
         except requests.exceptions.RequestException as e:
-            print(f"Request failed: {e}")
+            logger.exception("Request failed: %s", e)
             return f"Error: Request failed: {e}"
         except RequestError as e:
-            print(f"Error in pipe method: {e}")
+            logger.exception("Error in pipe method: %s", e)
             return f"Error: {e}"
 
-    def stream_response(
-        self, headers, payload, model_id, user, sponsored_allowance_name: str = None
+    def _log_token_usage(
+        self,
+        model_id: str,
+        user: dict,
+        tokens: TokenCount,
+        sponsored_allowance_name: str = None,
     ):
+        """
+        Log the token usage of a completed request in the background.
+
+        The database write is handed to a single worker thread so that the end of
+        the response does not wait for it. Once the usage is written, the user's
+        cached remaining credits are dropped. Prompt tokens read from the
+        provider's cache are logged separately, so that they are charged at the
+        discount of the ``cached_prompt_token_weight`` setting.
+
+        :param model_id: The ID of the model that was accessed
+        :type model_id: str
+        :param user: User information for token tracking
+        :type user: dict
+        :param tokens: Token count of the request
+        :type tokens: TokenCount
+        :param sponsored_allowance_name: The name of the sponsored allowance
+        :type sponsored_allowance_name: str, optional
+        """
+        provider = self.provider
+        prompt_tokens = tokens.prompt_tokens
+        response_tokens = tokens.response_tokens
+        if tokens.cached_tokens:
+            logger.debug(
+                "%s of %s prompt tokens read from cache",
+                tokens.cached_tokens,
+                tokens.prompt_tokens,
+            )
+
+        _PENDING_USAGE_LOGS.append(
+            (
+                self.token_tracker,
+                {
+                    "provider": provider,
+                    "model_id": model_id,
+                    "user": user,
+                    "prompt_tokens": prompt_tokens,
+                    "response_tokens": response_tokens,
+                    "cached_tokens": tokens.cached_tokens,
+                    "sponsored_allowance_name": sponsored_allowance_name,
+                    "log_date": datetime.datetime.now(datetime.UTC),
+                },
+            )
+        )
+        _USAGE_LOG_EXECUTOR.submit(_write_pending_usage_logs)
+
+    async def stream_response(
+        self, headers, payload, model_id, user, sponsored_allowance_name: str = None
+    ) -> AsyncGenerator:
         """
         Handle streaming responses from the API.
 
         Makes the streaming request and ensures token usage is logged
-        after the response is complete.
+        after the response is complete. The request is made and the provider's
+        (blocking) response generator is read by one thread of
+        :data:`_STREAM_EXECUTOR`, which passes the chunks on through a queue, so
+        that the event loop keeps serving other requests while waiting for the
+        next chunk.
 
         :param headers: HTTP headers for the request
         :type headers: dict
@@ -367,29 +617,64 @@ f"\nYour usage will reset in {_time_to_month_end()}.\n"
         :yield: Response chunks from the API
         :raises RequestError: If the API request fails
         """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        end = object()
+        stopped = threading.Event()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+            except RuntimeError:
+                # The event loop is closed, so nobody reads the response anymore
+                stopped.set()
+
+        def read_response():
+            try:
+                tokens, response_generator = self._make_stream_request(
+                    headers, payload
+                )
+                # Closing the generator releases the provider's connection, also
+                # if the client went away before the end of the response
+                with contextlib.closing(response_generator):
+                    for chunk in response_generator:
+                        if stopped.is_set():
+                            return None
+                        put(chunk)
+                return tokens
+            finally:
+                put(end)
+
+        reader = loop.run_in_executor(_STREAM_EXECUTOR, read_response)
         try:
-            tokens, response_generator = self._make_stream_request(headers, payload)
-
-            chunks = []
-            for chunk in response_generator:
-                chunks.append(chunk)
+            while (chunk := await chunks.get()) is not end:
                 yield chunk
+            tokens = await reader
 
-            self.token_tracker.log_token_usage(
-                provider=self.provider,
-                model_id=model_id,
-                user=user,
-                prompt_tokens=tokens.prompt_tokens,
-                response_tokens=tokens.response_tokens,
-                sponsored_allowance_name=sponsored_allowance_name,
+            self._log_token_usage(
+                model_id, user, tokens, sponsored_allowance_name=sponsored_allowance_name
             )
 
         except Exception as e:
-            print(f"Error in stream_response: {e}")
+            logger.exception("Error in stream_response: %s", e)
             yield f"Error: {e}"
+        finally:
+            # If the response was not read to its end, the reading thread stops
+            # and closes it once the chunk it is waiting for has arrived. Its
+            # errors were already reported above or concern a response nobody
+            # reads anymore.
+            stopped.set()
+            with contextlib.suppress(Exception):
+                await reader
 
     def non_stream_response(
-        self, headers, payload, model_id, user, sponsored_allowance_name: str = None
+        self,
+        headers,
+        payload,
+        model_id,
+        user,
+        sponsored_allowance_name: str = None,
+        cache_key: str = None,
     ):
         """
         Handle non-streaming responses from the API.
@@ -407,26 +692,26 @@ f"\nYour usage will reset in {_time_to_month_end()}.\n"
         :type user: dict
         :param sponsored_allowance_name: The name of the sponsored allowance
         :type sponsored_allowance_name: str, optional
+        :param cache_key: Key under which the response is cached for replay (see
+            :meth:`_response_cache_key`), None to not cache it
+        :type cache_key: str, optional
         :return: The API response
         :rtype: Any
         :raises RequestError: If the API request fails
         """
         try:
             tokens, response = self._make_non_stream_request(headers, payload)
+            if cache_key is not None:
+                self._response_cache.set(cache_key, (tokens, response))
 
-            self.token_tracker.log_token_usage(
-                provider=self.provider,
-                model_id=model_id,
-                user=user,
-                prompt_tokens=tokens.prompt_tokens,
-                response_tokens=tokens.response_tokens,
-                sponsored_allowance_name=sponsored_allowance_name,
+            self._log_token_usage(
+                model_id, user, tokens, sponsored_allowance_name=sponsored_allowance_name
             )
 
             return response
 
         except Exception as e:
-            print(f"Error in non_stream_response: {e}")
+            logger.exception("Error in non_stream_response: %s", e)
             return f"Error: {e}"
 
 
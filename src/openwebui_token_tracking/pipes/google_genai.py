@@ -4,16 +4,123 @@ This module provides a tracked pipe implementation for the Google Gemini API,
 handling both streaming and non-streaming responses while tracking token usage.
 """
 
+import base64
+import datetime
+import functools
+import hashlib
+import logging
 import os
+import time
+from types import MappingProxyType
+from urllib.parse import unquote_to_bytes
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig
-from openwebui_token_tracking.utils import pop_system_message
+from openwebui_token_tracking.utils import TTLCache, pop_system_message
 from pydantic import BaseModel, Field
 
 from typing import Any, Generator, Tuple
 from .base_tracked_pipe import BaseTrackedPipe, TokenCount
 
 
+logger = logging.getLogger(__name__)
+
+
+_PERMISSIVE_SAFETY_SETTINGS = MappingProxyType(
+    {
+        genai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+        genai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: genai.types.HarmBlockThreshold.BLOCK_NONE,
+        genai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+        genai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
+    }
+)
+"""Safety settings used with ``USE_PERMISSIVE_SAFETY``"""
+
+_DEFAULT_SAFETY_SETTINGS = MappingProxyType({})
+"""Safety settings leaving the API's defaults in place"""
+
+
+_configured_api_key = None
+"""API key the SDK is configured with"""
+
+
+_SYSTEM_CACHE_TTL = datetime.timedelta(hours=1)
+"""Lifetime of system prompts cached by the Gemini API"""
+
+_system_cache_models = TTLCache(
+    ttl=_SYSTEM_CACHE_TTL.total_seconds() - 300, maxsize=32
+)
+"""Models backed by a cached system prompt, keyed by model ID and prompt digest.
+Entries expire a few minutes before the cached content does."""
+
+
+@functools.lru_cache(maxsize=64)
+def _get_model(
+    model_id: str, system_instruction: str | None
+) -> genai.GenerativeModel:
+    """Get a (cached) model object. Models keep the API client they first use, so
+    the cache is cleared whenever the API key changes."""
+    if system_instruction:
+        return genai.GenerativeModel(
+            model_name=model_id, system_instruction=system_instruction
+        )
+    return genai.GenerativeModel(model_name=model_id)
+
+
+_ROLE_MAP = {"user": "user", "assistant": "model", "tool": "model"}
+"""Gemini roles of Open WebUI message roles; other roles are sent as model turns"""
+
+
+def _text_part(content: dict) -> dict:
+    return {"text": content["text"]}
+
+
+def _image_part(content: dict) -> dict:
+    image_url = content["image_url"]["url"]
+    if not image_url.startswith("data:image"):
+        return {"image_url": image_url}
+    # data:<MIME type>[;base64],<data>, sliced without splitting (and thereby
+    # copying) the whole URL
+    comma = image_url.find(",", 11)
+    mime_type, _, encoding = image_url[5:comma].partition(";")
+    # Decoded once here, so the request holds the raw bytes instead of their
+    # larger base64 text, which the SDK would decode again on every send
+    if encoding == "base64":
+        data = base64.b64decode(image_url[comma + 1 :])
+    else:
+        data = unquote_to_bytes(image_url[comma + 1 :])
+    return {"inline_data": {"mime_type": mime_type, "data": data}}
+
+
+_PART_BUILDERS = {"text": _text_part, "image_url": _image_part}
+"""Functions converting Open WebUI message content items into Gemini parts"""
+
+
+def _build_parts(content_list: list[dict]) -> list[dict]:
+    """Convert multimodal message content into Gemini parts, skipping content
+    types that Gemini does not support"""
+    builders = _PART_BUILDERS
+    return [
+        builders[content["type"]](content)
+        for content in content_list
+        if content["type"] in builders
+    ]
+
+
+def _configure(api_key: str):
+    """Configure the SDK with an API key unless it already uses it.
+
+    Configuring replaces the SDK's global clients, so it is skipped if the key
+    did not change. Otherwise, the cached models are dropped along with the
+    clients they hold."""
+    global _configured_api_key
+    if api_key == _configured_api_key:
+        return
+    genai.configure(api_key=api_key)
+    _get_model.cache_clear()
+    _system_cache_models.clear()
+    _configured_api_key = api_key
+
+
 class GoogleTrackedPipe(BaseTrackedPipe):
     """
     Tracked pipe implementation for Google's Gemini API.
@@ -36,12 +143,29 @@ class GoogleTrackedPipe(BaseTrackedPipe):
         :type GOOGLE_API_KEY: str
         :param USE_PERMISSIVE_SAFETY: Whether to use permissive safety settings
         :type USE_PERMISSIVE_SAFETY: bool
+        :param STREAM_BUFFER_CHARS: Number of streamed characters after which
+            buffered text is passed on
+        :type STREAM_BUFFER_CHARS: int
+        :param STREAM_FLUSH_MS: Time in milliseconds after which buffered text is
+            passed on with the next chunk
+        :type STREAM_FLUSH_MS: int
+        :param SYSTEM_CACHE_MIN_TOKENS: Estimated number of tokens from which
+            system prompts of Gemini 1.5 models are cached by the API (0 disables
+            caching)
+        :type SYSTEM_CACHE_MIN_TOKENS: int
+        :param CACHE_ENABLED: Whether to replay responses to identical
+            non-streaming requests with a temperature of 0 for an hour
+        :type CACHE_ENABLED: bool
         :param DEBUG: Enable debug logging
         :type DEBUG: bool
         """
 
         GOOGLE_API_KEY: str = Field(default="")
         USE_PERMISSIVE_SAFETY: bool = Field(default=False)
+        STREAM_BUFFER_CHARS: int = Field(default=8192)
+        STREAM_FLUSH_MS: int = Field(default=25)
+        SYSTEM_CACHE_MIN_TOKENS: int = Field(default=0)
+        CACHE_ENABLED: bool = Field(default=False)
         DEBUG: bool = Field(default=False)
 
     def __init__(self):
@@ -56,8 +180,7 @@ class GoogleTrackedPipe(BaseTrackedPipe):
                 "USE_PERMISSIVE_SAFETY": False,
             }
         )
-        # Repeat configure every time the pipe runs because the valve might change
-        genai.configure(api_key=self.valves.GOOGLE_API_KEY)
+        _configure(self.valves.GOOGLE_API_KEY)
 
     def _headers(self) -> dict:
         """
@@ -85,35 +208,21 @@ class GoogleTrackedPipe(BaseTrackedPipe):
         system_message, messages = pop_system_message(messages)
 
         contents = []
+        append = contents.append
+        roles = _ROLE_MAP
         for message in messages:
-            if message["role"] != "system":
-                if isinstance(message.get("content"), list):
-                    parts = []
-                    for content in message["content"]:
-                        if content["type"] == "text":
-                            parts.append({"text": content["text"]})
-                        elif content["type"] == "image_url":
-                            image_url = content["image_url"]["url"]
-                            if image_url.startswith("data:image"):
-                                image_data = image_url.split(",")[1]
-                                parts.append(
-                                    {
-                                        "inline_data": {
-                                            "mime_type": "image/jpeg",
-                                            "data": image_data,
-                                        }
-                                    }
-                                )
-                            else:
-                                parts.append({"image_url": image_url})
-                    contents.append({"role": message["role"], "parts": parts})
-                else:
-                    contents.append(
-                        {
-                            "role": "user" if message["role"] == "user" else "model",
-                            "parts": [{"text": message["content"]}],
-                        }
-                    )
+            role = message["role"]
+            if role == "system":
+                continue
+            content = message.get("content")
+            # Plain text is by far the most common content, so it is checked
+            # first with an exact type test
+            if type(content) is str or not isinstance(content, list):
+                append({"role": roles.get(role, "model"), "parts": [{"text": content}]})
+            else:
+                append(
+                    {"role": roles.get(role, "model"), "parts": _build_parts(content)}
+                )
 
         if system_message:
             contents.insert(
@@ -129,14 +238,11 @@ class GoogleTrackedPipe(BaseTrackedPipe):
             stop_sequences=body.get("stop", []),
         )
 
-        safety_settings = {}
-        if self.valves.USE_PERMISSIVE_SAFETY:
-            safety_settings = {
-                genai.types.HarmCategory.HARM_CATEGORY_HARASSMENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                genai.types.HarmCategory.HARM_CATEGORY_HATE_SPEECH: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                genai.types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-                genai.types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: genai.types.HarmBlockThreshold.BLOCK_NONE,
-            }
+        safety_settings = (
+            _PERMISSIVE_SAFETY_SETTINGS
+            if self.valves.USE_PERMISSIVE_SAFETY
+            else _DEFAULT_SAFETY_SETTINGS
+        )
 
         return {
             "model_id": model_id,
@@ -146,6 +252,53 @@ class GoogleTrackedPipe(BaseTrackedPipe):
             "system_message": system_message,
         }
 
+    def _model(
+        self, model_id: str, system_message: str | None
+    ) -> Tuple[genai.GenerativeModel, tuple | None]:
+        """
+        Get the model object for a request.
+
+        Long system prompts of models that take a system instruction are cached
+        by the Gemini API (see ``SYSTEM_CACHE_MIN_TOKENS``), so that they are not
+        processed again for every request.
+
+        :param model_id: The ID of the model being accessed
+        :type model_id: str
+        :param system_message: The system message of the request
+        :type system_message: str | None
+        :return: The model and, if it is backed by a cached system prompt, the key
+            to drop it from the cache with if it fails
+        :rtype: Tuple[genai.GenerativeModel, tuple | None]
+        """
+        if "gemini-1.5" not in model_id:
+            return _get_model(model_id, None), None
+
+        min_tokens = self.valves.SYSTEM_CACHE_MIN_TOKENS
+        if not (
+            min_tokens and system_message and len(system_message) // 4 >= min_tokens
+        ):
+            return _get_model(model_id, system_message), None
+
+        key = (model_id, hashlib.sha256(system_message.encode("utf-8")).digest())
+        model = _system_cache_models.get(key)
+        if model is None:
+            try:
+                cached_content = genai.caching.CachedContent.create(
+                    model=model_id,
+                    system_instruction=system_message,
+                    ttl=_SYSTEM_CACHE_TTL,
+                )
+            except Exception:
+                logger.warning(
+                    "Could not cache the system prompt for %s", model_id, exc_info=True
+                )
+                return _get_model(model_id, system_message), None
+            model = genai.GenerativeModel.from_cached_content(
+                cached_content=cached_content
+            )
+            _system_cache_models.set(key, model)
+        return model, key
+
     def _make_stream_request(
         self, headers: dict, payload: dict
     ) -> Tuple[TokenCount, Generator[Any, None, None]]:
@@ -159,30 +312,62 @@ class GoogleTrackedPipe(BaseTrackedPipe):
         :return: Tuple of TokenCount object and response generator
         :rtype: Tuple[TokenCount, Generator[Any, None, None]]
         """
-        model_id = payload.pop("model_id")
-        if "gemini-1.5" in model_id:
-            model = genai.GenerativeModel(
-                model_name=model_id, system_instruction=payload["system_message"]
-            )
-        else:
-            model = genai.GenerativeModel(model_name=model_id)
+        model, cache_key = self._model(
+            payload.pop("model_id"), payload["system_message"]
+        )
+        contents = payload["contents"]
+        if cache_key is not None:
+            # The system message is part of the cached content; skip the copy
+            # that _payload prepends to the contents
+            contents = contents[1:]
 
         tokens = TokenCount()
+        buffer_chars = self.valves.STREAM_BUFFER_CHARS
+        flush_interval = self.valves.STREAM_FLUSH_MS / 1000
 
         def generate_stream():
-            response = model.generate_content(
-                payload["contents"],
-                generation_config=payload["generation_config"],
-                safety_settings=payload["safety_settings"],
-                stream=True,
-            )
-
+            try:
+                response = model.generate_content(
+                    contents,
+                    generation_config=payload["generation_config"],
+                    safety_settings=payload["safety_settings"],
+                    stream=True,
+                )
+            except Exception:
+                if cache_key is not None:
+                    _system_cache_models.pop(cache_key)
+                raise
+
+            # Pass on the text in fewer, larger pieces: every piece becomes an
+            # event that Open WebUI has to process and send to the browser. The
+            # first piece is passed on right away to keep the response snappy.
+            buffer = []
+            buffered_chars = 0
+            last_flush = float("-inf")
+            chunk = None
             for chunk in response:
-                if chunk.text:
-                    yield chunk.text
-
+                text = chunk.text
+                if text:
+                    buffer.append(text)
+                    buffered_chars += len(text)
+                    now = time.monotonic()
+                    if (
+                        buffered_chars >= buffer_chars
+                        or now - last_flush >= flush_interval
+                    ):
+                        yield "".join(buffer)
+                        buffer.clear()
+                        buffered_chars = 0
+                        last_flush = now
+            if buffer:
+                yield "".join(buffer)
+
+            if chunk is None:
+                # An empty stream reports no usage; nothing is billed
+                return
             tokens.prompt_tokens = chunk.usage_metadata.prompt_token_count
             tokens.response_tokens = chunk.usage_metadata.candidates_token_count
+            tokens.cached_tokens = chunk.usage_metadata.cached_content_token_count
 
         return tokens, generate_stream()
 
@@ -199,27 +384,35 @@ class GoogleTrackedPipe(BaseTrackedPipe):
         :return: Tuple of TokenCount object and response text
         :rtype: Tuple[TokenCount, Any]
         """
-        model_id = payload.pop("model_id")
-        if "gemini-1.5" in model_id:
-            model = genai.GenerativeModel(
-                model_name=model_id, system_instruction=payload["system_message"]
-            )
-        else:
-            model = genai.GenerativeModel(model_name=model_id)
-
-        response = model.generate_content(
-            payload["contents"],
-            generation_config=payload["generation_config"],
-            safety_settings=payload["safety_settings"],
-            stream=False,
+        model, cache_key = self._model(
+            payload.pop("model_id"), payload["system_message"]
         )
+        contents = payload["contents"]
+        if cache_key is not None:
+            # The system message is part of the cached content; skip the copy
+            # that _payload prepends to the contents
+            contents = contents[1:]
+
+        try:
+            response = model.generate_content(
+                contents,
+                generation_config=payload["generation_config"],
+                safety_settings=payload["safety_settings"],
+                stream=False,
+            )
+        except Exception:
+            if cache_key is not None:
+                _system_cache_models.pop(cache_key)
+            raise
 
         tokens = TokenCount()
         tokens.prompt_tokens = response.usage_metadata.prompt_token_count
         tokens.response_tokens = response.usage_metadata.candidates_token_count
+        tokens.cached_tokens = response.usage_metadata.cached_content_token_count
 
         return tokens, response.text
 
-    def pipe(self, body, __user__, __metadata__):
-        genai.configure(api_key=self.valves.GOOGLE_API_KEY)
-        return super().pipe(body, __user__, __metadata__)
+    async def pipe(self, body, __user__, __metadata__):
+        # The valve might have changed since the last call
+        _configure(self.valves.GOOGLE_API_KEY)
+        return await super().pipe(body, __user__, __metadata__)
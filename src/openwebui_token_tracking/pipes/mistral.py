@@ -29,11 +29,15 @@ class MistralTrackedPipe(BaseTrackedPipe):
 
         :param MISTRAL_API_KEY: API key for authenticating with Mistral's API
         :type MISTRAL_API_KEY: str
+        :param CACHE_ENABLED: Whether to replay responses to identical
+            non-streaming requests with a temperature of 0 for an hour
+        :type CACHE_ENABLED: bool
         :param DEBUG: Enable debug logging
         :type DEBUG: bool
         """
 
         MISTRAL_API_KEY: str = Field(default="")
+        CACHE_ENABLED: bool = Field(default=False)
         DEBUG: bool = Field(default=False)
 
     def __init__(self):
@@ -45,16 +49,6 @@ class MistralTrackedPipe(BaseTrackedPipe):
             **{"MISTRAL_API_KEY": os.getenv("MISTRAL_API_KEY", "")}
         )
 
-    def _debug(self, message: str) -> None:
-        """
-        Print debug messages if debug mode is enabled.
-
-        :param message: The message to print
-        :type message: str
-        """
-        if self.valves.DEBUG:
-            print(message)
-
     def _headers(self) -> Dict[str, str]:
         """
         Get headers for API requests.
@@ -122,7 +116,7 @@ class MistralTrackedPipe(BaseTrackedPipe):
                         try:
                             line_data = line.decode("utf-8").lstrip("data: ")
                             event = json.loads(line_data)
-                            self._debug(f"Received stream event: {event}")
+                            self._debug("Received stream event: %s", event)
 
                             delta_content = (
                                 event.get("choices", [{}])[0]
@@ -143,7 +137,7 @@ class MistralTrackedPipe(BaseTrackedPipe):
                                 break
 
                         except json.JSONDecodeError:
-                            self._debug(f"Failed to decode stream line: {line}")
+                            self._debug("Failed to decode stream line: %r", line)
                             continue
 
             except requests.RequestException as e:
@@ -195,8 +189,8 @@ class MistralTrackedPipe(BaseTrackedPipe):
             response.raise_for_status()
             return response.json()
         except requests.exceptions.HTTPError as e:
-            self._debug(f"HTTPError: {e.response.text}")
+            self._debug("HTTPError: %s", e.response.text)
             raise RequestError(f"HTTP Error: {e}")
         except ValueError as e:
-            self._debug(f"Invalid JSON response: {response.text}")
+            self._debug("Invalid JSON response: %s", response.text)
             raise RequestError(f"Invalid JSON response: {e}")
@@ -1,10 +1,14 @@
+import logging
 import os
 import requests
 import json
 from pydantic import BaseModel, Field
 from typing import Generator, Any, Tuple
+from openwebui_token_tracking.utils import iter_sse_lines
 from .base_tracked_pipe import BaseTrackedPipe, RequestError, TokenCount
 
+logger = logging.getLogger(__name__)
+
 
 class OpenAITrackedPipe(BaseTrackedPipe):
     """
@@ -33,6 +37,10 @@ class OpenAITrackedPipe(BaseTrackedPipe):
         PROVIDER: str = Field(
             default="openai", description="Name of the model provider."
         )
+        CACHE_ENABLED: bool = Field(
+            default=False,
+            description="Replay responses to identical non-streaming requests with a temperature of 0 for an hour.",
+        )
         DEBUG: bool = Field(default=False)
 
     def __init__(self):
@@ -101,24 +109,32 @@ class OpenAITrackedPipe(BaseTrackedPipe):
                         f"HTTP Error {response.status_code}: {response.text}"
                     )
 
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode("utf-8")
-                        if line.startswith("data: "):
-                            try:
-                                data = json.loads(line[6:])
-                                if data.get("usage", None):
-                                    tokens.prompt_tokens = data["usage"].get(
-                                        "prompt_tokens"
-                                    )
-                                    tokens.response_tokens = data["usage"].get(
-                                        "completion_tokens"
-                                    )
-                            except json.JSONDecodeError:
-                                print(f"Failed to parse JSON: {line}")
-                            except KeyError as e:
-                                print(f"Unexpected data structure: {e}")
-                                print(f"Full data: {data}")
+                for line in iter_sse_lines(response):
+                    # Only the final frame carries token usage (earlier
+                    # frames have none or an explicit null), so the other
+                    # frames are passed through without being parsed
+                    parse = (
+                        b'"usage"' in line
+                        and b'"usage":null' not in line
+                        and line.startswith(b"data: ")
+                    )
+                    line = line.decode("utf-8")
+                    if parse:
+                        try:
+                            data = json.loads(line[6:])
+                            if data.get("usage", None):
+                                tokens.prompt_tokens = data["usage"].get(
+                                    "prompt_tokens"
+                                )
+                                tokens.response_tokens = data["usage"].get(
+                                    "completion_tokens"
+                                )
+                        except json.JSONDecodeError:
+                            logger.debug("Failed to parse JSON: %s", line)
+                        except KeyError as e:
+                            logger.debug(
+                                "Unexpected data structure: %s\nFull data: %s", e, data
+                            )
                     yield line
 
         return tokens, generate_stream()
@@ -157,7 +173,7 @@ class OpenAITrackedPipe(BaseTrackedPipe):
         self.url = f"{self.valves.API_BASE_URL.rstrip('/')}/v1/chat/completions"
         return super().pipes()
 
-    def pipe(self, body, __user__, __metadata__):
+    async def pipe(self, body, __user__, __metadata__):
         self.provider = self.valves.PROVIDER
         self.url = f"{self.valves.API_BASE_URL.rstrip('/')}/v1/chat/completions"
-        return super().pipe(body, __user__, __metadata__)
+        return await super().pipe(body, __user__, __metadata__)
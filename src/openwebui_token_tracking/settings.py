@@ -1,6 +1,6 @@
 from sqlalchemy.orm import Session
 
-from openwebui_token_tracking.db import init_db, BaseSetting
+from openwebui_token_tracking.db import get_engine, BaseSetting
 
 
 def init_base_settings(database_url: str, settings: list[dict[str, str]] | None = None):
@@ -19,10 +19,15 @@ def init_base_settings(database_url: str, settings: list[dict[str, str]] | None
                 "setting_key": "base_credit_allowance",
                 "setting_value": "1000",
                 "description": "Baseline credit allowance for all users.",
-            }
+            },
+            {
+                "setting_key": "cached_prompt_token_weight",
+                "setting_value": "0.25",
+                "description": "Fraction of the price charged for prompt tokens read from the provider's cache.",
+            },
         ]
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         for setting in settings:
             session.merge(BaseSetting(**setting))
@@ -1,13 +1,56 @@
 import os
-from typing import Iterable
+from typing import Iterable, Iterator
 
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session, selectinload
 
 from openwebui_token_tracking.db import (
-    init_db,
+    get_engine,
     SponsoredAllowance,
     SponsoredAllowanceBaseModels,
 )
+from openwebui_token_tracking.tracking import TokenTracker
+
+
+def _insert_base_models(session: Session, allowance_id, models: Iterable[str]):
+    """Insert the base model associations of a sponsored allowance in one
+    executemany statement instead of one ORM INSERT per model.
+
+    :param session: The session of the current transaction.
+    :type session: Session
+    :param allowance_id: The ID of the sponsored allowance.
+    :type allowance_id: uuid.UUID
+    :param models: The base model IDs to associate with the allowance.
+    :type models: Iterable[str]
+    """
+    rows = [
+        {"sponsored_allowance_id": allowance_id, "base_model_id": base_model_id}
+        for base_model_id in models
+    ]
+    if rows:
+        session.execute(SponsoredAllowanceBaseModels.__table__.insert(), rows)
+
+
+def _allowance_to_dict(allowance: SponsoredAllowance) -> dict:
+    """Serialize a sponsored allowance with its base models, which must have
+    been loaded, so that the result stays usable after the session is closed.
+
+    :param allowance: The sponsored allowance.
+    :type allowance: SponsoredAllowance
+    :return: The sponsored allowance as a dictionary.
+    :rtype: dict
+    """
+    return {
+        "id": str(allowance.id),
+        "name": allowance.name,
+        "sponsor_id": allowance.sponsor_id,
+        "total_credit_limit": allowance.total_credit_limit,
+        "monthly_credit_limit": allowance.monthly_credit_limit,
+        "base_models": [
+            {"base_model_id": association.base_model_id}
+            for association in allowance.base_models
+        ],
+    }
 
 
 def create_sponsored_allowance(
@@ -21,7 +64,7 @@ def create_sponsored_allowance(
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
         sponsored_allowance = SponsoredAllowance(
             sponsor_id=sponsor_id,
@@ -30,14 +73,11 @@ def create_sponsored_allowance(
             monthly_credit_limit=monthly_credit_limit,
         )
 
-        # Create the base model associations
-        for base_model_id in models:
-            association = SponsoredAllowanceBaseModels(
-                sponsored_allowance=sponsored_allowance, base_model_id=base_model_id
-            )
-            sponsored_allowance.base_models.append(association)
-
         session.add(sponsored_allowance)
+        # Flush to assign the allowance's ID before inserting its associations
+        session.flush()
+
+        _insert_base_models(session, sponsored_allowance.id, models)
         session.commit()
 
 
@@ -63,29 +103,47 @@ def delete_sponsored_allowance(
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
 
-    engine = init_db(database_url)
-    with Session(engine) as session:
-        query = session.query(SponsoredAllowance)
+    if allowance_id is not None:
+        condition = SponsoredAllowance.id == allowance_id
+    else:
+        condition = SponsoredAllowance.name == name
 
-        if allowance_id is not None:
-            query = query.filter(SponsoredAllowance.id == allowance_id)
+    engine = get_engine(database_url)
+    with Session(engine) as session:
+        # Delete the associations and the allowance without loading the
+        # allowance first; the session rolls back if nothing was deleted
+        session.execute(
+            delete(SponsoredAllowanceBaseModels).where(
+                SponsoredAllowanceBaseModels.sponsored_allowance_id.in_(
+                    select(SponsoredAllowance.id).where(condition)
+                )
+            ),
+            execution_options={"synchronize_session": False},
+        )
+        delete_allowance = delete(SponsoredAllowance).where(condition)
+        if engine.dialect.delete_returning:
+            deleted = session.execute(
+                delete_allowance.returning(SponsoredAllowance.id),
+                execution_options={"synchronize_session": False},
+            ).scalar_one_or_none()
         else:
-            query = query.filter(SponsoredAllowance.name == name)
-
-        sponsored_allowance = query.first()
+            # E.g., MySQL cannot return deleted rows, but the row count tells
+            # whether the allowance existed
+            deleted = (
+                session.execute(
+                    delete_allowance,
+                    execution_options={"synchronize_session": False},
+                ).rowcount
+                or None
+            )
 
-        if sponsored_allowance is None:
+        if deleted is None:
             raise ValueError(
                 f"No sponsored allowance found with the given {'ID' if allowance_id else 'name'}"
             )
 
-        session.query(SponsoredAllowanceBaseModels).filter(
-            SponsoredAllowanceBaseModels.sponsored_allowance_id
-            == sponsored_allowance.id
-        ).delete(synchronize_session=False)
-
-        session.delete(sponsored_allowance)
         session.commit()
+    TokenTracker.shared(database_url).invalidate_sponsored_allowance_ids()
 
 
 def get_sponsored_allowance(
@@ -111,72 +169,102 @@ def get_sponsored_allowance(
     if name is None and id is None:
         raise ValueError("Either name or id must be provided")
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
-        query = session.query(SponsoredAllowance)
+        options = [selectinload(SponsoredAllowance.base_models)]
 
-        if name is not None:
-            query = query.filter(SponsoredAllowance.name == name)
         if id is not None:
-            query = query.filter(SponsoredAllowance.id == id)
-
-        sponsored_allowance = query.first()
+            # Look up by primary key, which the identity map can answer
+            sponsored_allowance = session.get(SponsoredAllowance, id, options=options)
+            if sponsored_allowance is not None and name not in (
+                None,
+                sponsored_allowance.name,
+            ):
+                sponsored_allowance = None
+        else:
+            sponsored_allowance = (
+                session.execute(
+                    select(SponsoredAllowance)
+                    .options(*options)
+                    .where(SponsoredAllowance.name == name)
+                )
+                .scalars()
+                .first()
+            )
 
         if sponsored_allowance is None:
             raise KeyError(f"Could not find sponsored allowance: {id=}, {name=}")
 
-        return {
-            "id": str(sponsored_allowance.id),
-            "name": sponsored_allowance.name,
-            "sponsor_id": sponsored_allowance.sponsor_id,
-            "total_credit_limit": sponsored_allowance.total_credit_limit,
-            "monthly_credit_limit": sponsored_allowance.monthly_credit_limit,
-            "base_models": sponsored_allowance.base_models,
-        }
+        return _allowance_to_dict(sponsored_allowance)
 
 
-def get_sponsored_allowances(
+def iter_sponsored_allowances(
     database_url: str = None,
     sponsor_id: str = None,
-):
-    """Get all sponsored allowances, optionally filtered by sponsor ID.
+    order_by_name: bool = True,
+) -> Iterator[dict]:
+    """Iterate over all sponsored allowances, optionally filtered by sponsor ID.
+
+    The allowances are fetched from the database in batches while iterating, so
+    large listings are never held in memory at once. The database session stays
+    open until the iterator is exhausted or closed.
 
     :param database_url: The database connection URL. If None, uses the DATABASE_URL environment variable.
     :type database_url: str, optional
     :param sponsor_id: Filter allowances by sponsor ID.
     :type sponsor_id: str, optional
-    :return: List of sponsored allowances, each as a dictionary.
-    :rtype: list[dict]
+    :param order_by_name: Whether to order the allowances by name. Callers that
+        do not need a stable order can pass False to skip the sort.
+    :type order_by_name: bool, optional
+    :return: Iterator over the sponsored allowances, each as a dictionary.
+    :rtype: Iterator[dict]
     """
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
 
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
     with Session(engine) as session:
-        query = session.query(SponsoredAllowance)
+        # Load the base models of each batch of allowances in one extra query
+        # instead of lazily loading them allowance by allowance
+        stmt = select(SponsoredAllowance).options(
+            selectinload(SponsoredAllowance.base_models)
+        )
 
         if sponsor_id is not None:
-            query = query.filter(SponsoredAllowance.sponsor_id == sponsor_id)
-
-        # Order by name for consistent results
-        query = query.order_by(SponsoredAllowance.name)
-
-        sponsored_allowances = query.all()
-
-        result = []
-        for allowance in sponsored_allowances:
-            result.append(
-                {
-                    "id": str(allowance.id),
-                    "name": allowance.name,
-                    "sponsor_id": allowance.sponsor_id,
-                    "total_credit_limit": allowance.total_credit_limit,
-                    "monthly_credit_limit": allowance.monthly_credit_limit,
-                    "base_models": allowance.base_models,
-                }
-            )
+            stmt = stmt.where(SponsoredAllowance.sponsor_id == sponsor_id)
 
-        return result
+        if order_by_name:
+            # Order by name for consistent results
+            stmt = stmt.order_by(SponsoredAllowance.name)
+
+        for allowance in session.scalars(stmt.execution_options(yield_per=500)):
+            yield _allowance_to_dict(allowance)
+
+
+def get_sponsored_allowances(
+    database_url: str = None,
+    sponsor_id: str = None,
+    order_by_name: bool = True,
+):
+    """Get all sponsored allowances, optionally filtered by sponsor ID.
+
+    :param database_url: The database connection URL. If None, uses the DATABASE_URL environment variable.
+    :type database_url: str, optional
+    :param sponsor_id: Filter allowances by sponsor ID.
+    :type sponsor_id: str, optional
+    :param order_by_name: Whether to order the allowances by name. Callers that
+        do not need a stable order can pass False to skip the sort.
+    :type order_by_name: bool, optional
+    :return: List of sponsored allowances, each as a dictionary.
+    :rtype: list[dict]
+    """
+    return list(
+        iter_sponsored_allowances(
+            database_url=database_url,
+            sponsor_id=sponsor_id,
+            order_by_name=order_by_name,
+        )
+    )
 
 
 def update_sponsored_allowance(
@@ -216,41 +304,74 @@ def update_sponsored_allowance(
     if database_url is None:
         database_url = os.environ["DATABASE_URL"]
 
-    engine = init_db(database_url)
+    if allowance_id is not None:
+        condition = SponsoredAllowance.id == allowance_id
+    else:
+        condition = SponsoredAllowance.name == name
+
+    changes = {
+        column: value
+        for column, value in (
+            ("name", new_name),
+            ("sponsor_id", sponsor_id),
+            ("total_credit_limit", total_credit_limit),
+            ("monthly_credit_limit", monthly_credit_limit),
+        )
+        if value is not None
+    }
+
+    engine = get_engine(database_url)
     with Session(engine) as session:
-        query = session.query(SponsoredAllowance)
-        if allowance_id is not None:
-            query = query.filter(SponsoredAllowance.id == allowance_id)
+        if changes and engine.dialect.update_returning:
+            sponsored_allowance_id = session.execute(
+                update(SponsoredAllowance)
+                .where(condition)
+                .values(**changes)
+                .returning(SponsoredAllowance.id),
+                execution_options={"synchronize_session": False},
+            ).scalar_one_or_none()
         else:
-            query = query.filter(SponsoredAllowance.name == name)
+            sponsored_allowance_id = session.execute(
+                select(SponsoredAllowance.id).where(condition)
+            ).scalar_one_or_none()
+            if changes and sponsored_allowance_id is not None:
+                # E.g., MySQL cannot return updated rows, so the ID is read first
+                session.execute(
+                    update(SponsoredAllowance)
+                    .where(SponsoredAllowance.id == sponsored_allowance_id)
+                    .values(**changes),
+                    execution_options={"synchronize_session": False},
+                )
 
-        sponsored_allowance = query.first()
-        if sponsored_allowance is None:
+        if sponsored_allowance_id is None:
             raise ValueError(
                 f"No sponsored allowance found with the given {'ID' if allowance_id else 'name'}"
             )
 
-        if new_name is not None:
-            sponsored_allowance.name = new_name
-        if sponsor_id is not None:
-            sponsored_allowance.sponsor_id = sponsor_id
-        if total_credit_limit is not None:
-            sponsored_allowance.total_credit_limit = total_credit_limit
-        if monthly_credit_limit is not None:
-            sponsored_allowance.monthly_credit_limit = monthly_credit_limit
-
         if models is not None:
-            # Delete existing model associations
-            session.query(SponsoredAllowanceBaseModels).filter(
-                SponsoredAllowanceBaseModels.sponsored_allowance_id
-                == sponsored_allowance.id
-            ).delete(synchronize_session=False)
-
-            # Create new model associations
-            for base_model_id in models:
-                association = SponsoredAllowanceBaseModels(
-                    sponsored_allowance=sponsored_allowance, base_model_id=base_model_id
+            # Only write the associations that actually change
+            existing = set(
+                session.execute(
+                    select(SponsoredAllowanceBaseModels.base_model_id).where(
+                        SponsoredAllowanceBaseModels.sponsored_allowance_id
+                        == sponsored_allowance_id
+                    )
+                ).scalars()
+            )
+            desired = set(models)
+            removed = existing - desired
+
+            if removed:
+                session.execute(
+                    delete(SponsoredAllowanceBaseModels).where(
+                        SponsoredAllowanceBaseModels.sponsored_allowance_id
+                        == sponsored_allowance_id,
+                        SponsoredAllowanceBaseModels.base_model_id.in_(removed),
+                    ),
+                    execution_options={"synchronize_session": False},
                 )
-                sponsored_allowance.base_models.append(association)
+            _insert_base_models(session, sponsored_allowance_id, desired - existing)
 
         session.commit()
+    if new_name is not None:
+        TokenTracker.shared(database_url).invalidate_sponsored_allowance_ids()
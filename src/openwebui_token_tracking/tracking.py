@@ -1,25 +1,78 @@
-from openwebui_token_tracking.db import init_db
+from openwebui_token_tracking.db import get_engine
 from openwebui_token_tracking.db.token_usage import TokenUsageLog
 from openwebui_token_tracking.db.credit_group import CreditGroup, CreditGroupUser
 from openwebui_token_tracking.db.settings import BaseSetting
 from openwebui_token_tracking.db.model_pricing import ModelPricing
 from openwebui_token_tracking.models import ModelPricingSchema
 from openwebui_token_tracking.db.sponsored import SponsoredAllowance
-from openwebui_token_tracking.sponsored import get_sponsored_allowance
+from openwebui_token_tracking.utils import TTLCache
 
 
+from pydantic import TypeAdapter
 import sqlalchemy as db
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, sessionmaker
 
-from datetime import datetime, date, UTC
-from calendar import monthrange
+import asyncio
+from datetime import datetime, time, timedelta, UTC
 import logging
+import threading
 from typing import Iterable
 from uuid import UUID
 
 logger = logging.getLogger(__name__)
 
 
+_MODELS_ADAPTER = TypeAdapter(list[ModelPricingSchema])
+"""Validator of model pricing rows, built once per process and applied to all rows
+read by :meth:`TokenTracker.get_models` in a single call."""
+
+
+DEFAULT_CACHED_PROMPT_TOKEN_WEIGHT = 0.25
+"""Fraction of the full price charged for prompt tokens read from the provider's
+cache if the ``cached_prompt_token_weight`` setting is missing"""
+
+_CACHED_PROMPT_TOKEN_WEIGHT = db.func.coalesce(
+    db.select(db.cast(BaseSetting.setting_value, db.Float))
+    .where(BaseSetting.setting_key == "cached_prompt_token_weight")
+    .scalar_subquery(),
+    DEFAULT_CACHED_PROMPT_TOKEN_WEIGHT,
+)
+
+_BILLED_PROMPT_TOKENS = TokenUsageLog.prompt_tokens - db.cast(
+    db.func.round(TokenUsageLog.cached_tokens * (1 - _CACHED_PROMPT_TOKEN_WEIGHT)),
+    db.Integer,
+)
+"""Prompt tokens of a usage log entry, with the cached ones weighted by the
+``cached_prompt_token_weight`` setting"""
+
+_USED_CREDITS_QUERY = (
+    db.select(
+        db.func.coalesce(
+            db.func.sum(
+                _BILLED_PROMPT_TOKENS
+                * ModelPricing.input_cost_credits
+                / ModelPricing.per_input_tokens
+                + TokenUsageLog.response_tokens
+                * ModelPricing.output_cost_credits
+                / ModelPricing.per_output_tokens
+            ),
+            0,
+        )
+    )
+    .select_from(TokenUsageLog)
+    .join(
+        ModelPricing,
+        db.and_(
+            ModelPricing.provider == TokenUsageLog.provider,
+            ModelPricing.id == TokenUsageLog.model_id,
+        ),
+    )
+)
+"""Query summing the credits of usage log entries, built once since statements
+are immutable; conditions are added per call. The compiled SQL is cached by the
+engine."""
+
+
 class TokenLimitExceededError(Exception):
     """Raised when a token limit was exceeded"""
 
@@ -55,36 +108,45 @@ class TokenTracker:
     :raises MonthlyTokenLimitExceededError: When a monthly token limit is exceeded
     :raises TotalTokenLimitExceededError: When a total token limit is exceeded
     """
+    _shared: dict[str, "TokenTracker"] = {}
+    _shared_lock = threading.Lock()
+
+    MODELS_CACHE_TTL = 300
+    """Time in seconds for which :meth:`get_models` reuses the models it read"""
+    SPONSORED_ALLOWANCE_ID_CACHE_TTL = 60
+    """Time in seconds for which the IDs of sponsored allowances are reused"""
+
     def __init__(self, db_url: str):
-        self.db_engine = init_db(db_url)
+        # Shares the engine's connection pool with the module-level helpers
+        self.db_engine = get_engine(db_url)
         self.db_url = db_url
+        # Loaded attributes stay usable after a commit instead of being read again
+        self._Session = sessionmaker(bind=self.db_engine, expire_on_commit=False)
+        self._models_cache = TTLCache(ttl=self.MODELS_CACHE_TTL, maxsize=64)
+        self._sponsored_allowance_ids = TTLCache(
+            ttl=self.SPONSORED_ALLOWANCE_ID_CACHE_TTL, maxsize=1024
+        )
 
-    def _calc_credits_from_tokens(
-        self, records: Iterable[tuple[str, int, int]], models: list[ModelPricingSchema]
-    ) -> int:
-        """Calculates the number of consumed credits from a series of token logs
-
-        :param records: A token log record consisting of the model ID, the number of
-        consumed input tokens, and the number of consumed output tokens
-        :type records: Iterable[tuple[str, int, int]]
-        :param models: A list of the pricing schemas of all models appearing in the records
-        :type models: list[ModelPricingSchema]
-        :return: Total number of credits used
-        :rtype: int
-        """
-        used_credits = 0
-        for row in records:
-            (cur_model, cur_prompt_tokens, cur_response_tokens) = row
-            model_data = next((item for item in models if item.id == cur_model), None)
+    @classmethod
+    def shared(cls, db_url: str) -> "TokenTracker":
+        """Get the process-wide tracker for a database URL, creating it on first use.
 
-            model_cost = (
-                model_data.input_cost_credits / model_data.per_input_tokens
-            ) * cur_prompt_tokens + (
-                model_data.output_cost_credits / model_data.per_output_tokens
-            ) * cur_response_tokens
+        Sharing the tracker shares its engine and thereby its connection pool, so
+        pipes and actions that are instantiated repeatedly do not set up a new
+        engine each time.
 
-            used_credits += model_cost
-        return used_credits
+        :param db_url: Database connection URL
+        :type db_url: str
+        :return: The shared tracker
+        :rtype: TokenTracker
+        """
+        tracker = cls._shared.get(db_url)
+        if tracker is None:
+            with cls._shared_lock:
+                tracker = cls._shared.get(db_url)
+                if tracker is None:
+                    tracker = cls._shared[db_url] = cls(db_url)
+        return tracker
 
     def _remaining_user_credits(
         self, user: dict, sponsored_allowance_id: UUID | None
@@ -103,86 +165,205 @@ class TokenTracker:
         :rtype: int
         """
 
-        with Session(self.db_engine) as session:
-            current_date = date.today()
-            current_year = current_date.year
-            current_month = current_date.month
-            # Get first and last day of current month
-            first_day = date(current_year, current_month, 1)
-            last_day = date(current_year, current_month, monthrange(current_year, current_month)[1])
-            
-            logger.debug(f"Current month range: {first_day} to {last_day}")
-            models = self.get_models()
-            model_list = [m.id for m in models]
-
-            query = (
+        max_credits, used_monthly_credits = self._max_and_used_credits(
+            user["id"], sponsored_allowance_id
+        )
+        return max_credits - int(used_monthly_credits)
+
+    def _max_and_used_credits(
+        self, user_id: str, sponsored_allowance_id: UUID | None
+    ) -> tuple[int, float]:
+        """Read a user's monthly credit limit and the credits used in the current
+        month in a single statement.
+
+        :param user_id: ID of the user
+        :type user_id: str
+        :param sponsored_allowance_id: ID of a sponsored allowance to consider
+        :type sponsored_allowance_id: UUID, optional
+        :return: Maximum monthly credits and used monthly credits
+        :rtype: tuple[int, float]
+        """
+        if sponsored_allowance_id is None:
+            max_credits_query = self._max_user_credits_query(user_id)
+        else:
+            max_credits_query = db.select(SponsoredAllowance.monthly_credit_limit).where(
+                SponsoredAllowance.id == sponsored_allowance_id
+            )
+
+        with self._Session() as session:
+            max_credits, used_monthly_credits = session.execute(
                 db.select(
-                    TokenUsageLog.model_id,
-                    db.func.sum(TokenUsageLog.prompt_tokens).label("prompt_tokens_sum"),
-                    db.func.sum(TokenUsageLog.response_tokens).label(
-                        "response_tokens_sum"
-                    ),
+                    max_credits_query.scalar_subquery(),
+                    self._monthly_usage_query(
+                        user_id, sponsored_allowance_id
+                    ).scalar_subquery(),
                 )
-                .where(
-                    TokenUsageLog.user_id == user["id"],
-                    db.func.date(TokenUsageLog.log_date) >= first_day,
-                    db.func.date(TokenUsageLog.log_date) <= last_day,
-                    TokenUsageLog.model_id.in_(model_list),
-                    TokenUsageLog.sponsored_allowance_id == sponsored_allowance_id,
-                )
-                .group_by(TokenUsageLog.model_id)
-            )
-            results = session.execute(query).fetchall()
+            ).one()
+        return max_credits, used_monthly_credits
 
-            used_monthly_credits = self._calc_credits_from_tokens(
-                records=results, models=models
-            )
+    def _used_credits_query(self, *conditions) -> db.Select:
+        """Build the query summing the credits of the usage log entries matching
+        the conditions.
 
-        return self.max_credits(
-            user, sponsored_allowance_id=sponsored_allowance_id
-        ) - int(used_monthly_credits)
+        The credits are calculated in the database by joining each entry with
+        its model's pricing, so a single value is returned instead of token sums
+        per model. Entries of models without pricing are not counted.
 
-    def _remaining_sponsored_credits(self, sponsored_allowance_id: str):
-        """Get remaining credits in a sponsored allowance
+        :param conditions: Conditions on the :class:`TokenUsageLog` entries
+        :return: Query returning the used credits as a single value
+        :rtype: sqlalchemy.Select
+        """
+        return _USED_CREDITS_QUERY.where(*conditions)
 
-        :param sponsored_allowance_id: ID of the sponsored allowance
-        :type sponsored_allowance_id: str
-        :return: Remaining credits in the allowance
-        :rtype: int
+    def _monthly_usage_query(
+        self, user_id: str, sponsored_allowance_id: UUID | None
+    ) -> db.Select:
+        """Build the query summing a user's used credits in the current month.
+
+        :param user_id: ID of the user
+        :type user_id: str
+        :param sponsored_allowance_id: ID of a sponsored allowance to consider
+        :type sponsored_allowance_id: UUID, optional
+        :return: Query returning the used credits as a single value
+        :rtype: sqlalchemy.Select
         """
+        # Usage is logged in UTC, so months are UTC months as well
+        current_date = datetime.now(UTC)
+        current_year = current_date.year
+        current_month = current_date.month
+        # The month is compared as a half-open range on the bare column, so that
+        # the database can use an index on the log date
+        first_day = datetime(current_year, current_month, 1, tzinfo=UTC)
+        next_month_first_day = datetime(
+            current_year + (current_month == 12), current_month % 12 + 1, 1, tzinfo=UTC
+        )
 
-        with Session(self.db_engine) as session:
-            query = db.select(
-                SponsoredAllowance.creation_date,
-                SponsoredAllowance.total_credit_limit,
-            ).where(SponsoredAllowance.id == sponsored_allowance_id)
+        logger.debug(f"Current month range: {first_day} to {next_month_first_day}")
 
-            creation_date, total_credit_limit = session.execute(query).first()
+        return self._used_credits_query(
+            TokenUsageLog.user_id == user_id,
+            TokenUsageLog.log_date >= first_day,
+            TokenUsageLog.log_date < next_month_first_day,
+            TokenUsageLog.sponsored_allowance_id == sponsored_allowance_id,
+        )
 
-            models = self.get_models()
-            model_list = [m.id for m in models]
+    def _max_user_credits_query(self, user_id: str) -> db.Select:
+        """Build the query for a user's monthly credit limit, i.e., the base
+        allowance plus the allowances of all the user's credit groups.
 
-            query = (
+        :param user_id: ID of the user
+        :type user_id: str
+        :return: Query returning the maximum monthly credits as a single value
+        :rtype: sqlalchemy.Select
+        """
+        base_allowance = (
+            db.select(db.cast(BaseSetting.setting_value, db.Integer))
+            .where(BaseSetting.setting_key == "base_credit_allowance")
+            .scalar_subquery()
+        )
+        group_allowances = (
+            db.select(db.func.coalesce(db.func.sum(CreditGroup.max_credit), 0))
+            .join(
+                CreditGroupUser,
+                CreditGroup.id == CreditGroupUser.credit_group_id,
+            )
+            .where(CreditGroupUser.user_id == user_id)
+            .scalar_subquery()
+        )
+        return db.select(base_allowance + group_allowances)
+
+    def _remaining_sponsored_credits(
+        self, user: dict, sponsored_allowance_name: str
+    ) -> tuple[int, int]:
+        """Get a user's remaining monthly credits in a sponsored allowance and the
+        remaining total credits of the allowance.
+
+        The allowance is read once, and both usages are summed in a single
+        statement.
+
+        :param user: User
+        :type user: dict
+        :param sponsored_allowance_name: Name of the sponsored allowance
+        :type sponsored_allowance_name: str
+        :return: Remaining monthly credits available to the user, and remaining
+            total credits in the allowance
+        :rtype: tuple[int, int]
+        :raises KeyError: If no sponsored allowance has the given name
+        """
+        with self._Session() as session:
+            allowance = session.execute(
                 db.select(
-                    TokenUsageLog.model_id,
-                    db.func.sum(TokenUsageLog.prompt_tokens).label("prompt_tokens_sum"),
-                    db.func.sum(TokenUsageLog.response_tokens).label(
-                        "response_tokens_sum"
-                    ),
+                    SponsoredAllowance.id,
+                    SponsoredAllowance.creation_date,
+                    SponsoredAllowance.monthly_credit_limit,
+                    SponsoredAllowance.total_credit_limit,
+                ).where(SponsoredAllowance.name == sponsored_allowance_name)
+            ).one_or_none()
+            if allowance is None:
+                raise KeyError(
+                    f"Could not find sponsored allowance: name={sponsored_allowance_name!r}"
                 )
-                .where(
-                    TokenUsageLog.sponsored_allowance_id == sponsored_allowance_id,
-                    db.func.date(TokenUsageLog.log_date) <= creation_date,
-                    TokenUsageLog.model_id.in_(model_list),
+
+            used_monthly_credits, total_credits_used = session.execute(
+                db.select(
+                    self._monthly_usage_query(user["id"], allowance.id).scalar_subquery(),
+                    self._used_credits_query(
+                        TokenUsageLog.sponsored_allowance_id == allowance.id,
+                        # Usage logged up to the end of the creation day
+                        TokenUsageLog.log_date
+                        < datetime.combine(
+                            allowance.creation_date.date() + timedelta(days=1),
+                            time.min,
+                            tzinfo=allowance.creation_date.tzinfo,
+                        ),
+                    ).scalar_subquery(),
                 )
-                .group_by(TokenUsageLog.model_id)
-            )
-            results = session.execute(query).fetchall()
+            ).one()
 
-            total_credits_used = self._calc_credits_from_tokens(
-                records=results, models=models
+        return (
+            allowance.monthly_credit_limit - int(used_monthly_credits),
+            int(allowance.total_credit_limit - total_credits_used),
+        )
+
+    def _sponsored_allowance_id(
+        self,
+        sponsored_allowance_name: str,
+        session: Session | db.Connection | None = None,
+    ) -> UUID:
+        """Get the ID of a sponsored allowance by its name.
+
+        :param sponsored_allowance_name: Name of the sponsored allowance
+        :type sponsored_allowance_name: str
+        :param session: Session or connection to read the ID in, if not cached.
+            Defaults to a new session.
+        :type session: Session | Connection, optional
+        :return: ID of the sponsored allowance
+        :rtype: UUID
+        :raises KeyError: If no sponsored allowance has the given name
+        """
+        sponsored_allowance_id = self._sponsored_allowance_ids.get(
+            sponsored_allowance_name
+        )
+        if sponsored_allowance_id is not None:
+            return sponsored_allowance_id
+
+        query = db.select(SponsoredAllowance.id).where(
+            SponsoredAllowance.name == sponsored_allowance_name
+        )
+        if session is None:
+            with self._Session() as session:
+                sponsored_allowance_id = session.scalar(query)
+        else:
+            sponsored_allowance_id = session.scalar(query)
+
+        if sponsored_allowance_id is None:
+            raise KeyError(
+                f"Could not find sponsored allowance: name={sponsored_allowance_name!r}"
             )
-            return int(total_credit_limit - total_credits_used)
+        self._sponsored_allowance_ids.set(
+            sponsored_allowance_name, sponsored_allowance_id
+        )
+        return sponsored_allowance_id
 
     def get_models(
         self, provider: str = None, id: str = None
@@ -194,19 +375,30 @@ class TokenTracker:
         :return: A description of the models' pricing schema
         :rtype: list[ModelPricingSchema]
         """
-
-        with Session(self.db_engine) as session:
-            if provider is None:
-                models = session.query(ModelPricing).all()
-            else:
-                models = (
-                    session.query(ModelPricing)
-                    .filter(ModelPricing.provider == provider)
-                    .all()
-                )
-        return [
-            ModelPricingSchema.model_validate(m, from_attributes=True) for m in models
-        ]
+        # Pricing rarely changes, but is needed by every credit check; changes
+        # made through another tracker or process show up within the cache TTL
+        cached = self._models_cache.get(provider)
+        if cached is not None:
+            return cached
+
+        with self._Session() as session:
+            query = db.select(ModelPricing.__table__)
+            if provider is not None:
+                query = query.where(ModelPricing.provider == provider)
+            rows = session.execute(query).mappings().all()
+        models = _MODELS_ADAPTER.validate_python(rows)
+        self._models_cache.set(provider, models)
+        return models
+
+    def invalidate_models_cache(self):
+        """Discard the models cached by :meth:`get_models`, e.g., after changing
+        model pricing, so that the next call reads them from the database."""
+        self._models_cache.clear()
+
+    def invalidate_sponsored_allowance_ids(self):
+        """Discard the cached IDs of sponsored allowances, e.g., after renaming or
+        deleting a sponsored allowance, so that names are resolved again."""
+        self._sponsored_allowance_ids.clear()
 
     def is_paid(self, model_id: str) -> bool:
         """Check whether a model requires credits to use
@@ -216,12 +408,31 @@ class TokenTracker:
         :return: True if credits are required to use this model, False otherwise
         :rtype: bool
         """
-        model = [m for m in self.get_models() if m.id == model_id]
-        if len(model) != 1:
+        models = self._models_cache.get(None)
+        if models is not None:
+            costs = [
+                (m.input_cost_credits, m.output_cost_credits)
+                for m in models
+                if m.id == model_id
+            ]
+        else:
+            # Read only the costs of the model instead of all models; two rows
+            # suffice to tell whether the model is unique
+            with self._Session() as session:
+                costs = session.execute(
+                    db.select(
+                        ModelPricing.input_cost_credits,
+                        ModelPricing.output_cost_credits,
+                    )
+                    .where(ModelPricing.id == model_id)
+                    .limit(2)
+                ).all()
+        if len(costs) != 1:
             raise RuntimeError(
                 f"Could not uniquely determine the model based on {model_id=}!"
             )
-        return model[0].input_cost_credits > 0 or model[0].output_cost_credits > 0
+        input_cost_credits, output_cost_credits = costs[0]
+        return input_cost_credits > 0 or output_cost_credits > 0
 
     def max_credits(
         self,
@@ -245,41 +456,56 @@ class TokenTracker:
                 """Pass either `sponsored_allowance_name` or
                 `sponsored_allowance_id`, not both!"""
             )
-        with Session(self.db_engine) as session:
+        with self._Session() as session:
             if sponsored_allowance_name is None and sponsored_allowance_id is None:
-                base_allowance = int(
-                    session.query(BaseSetting)
-                    .filter(BaseSetting.setting_key == "base_credit_allowance")
-                    .scalar()
-                    .setting_value
-                )
-                group_allowances = (
-                    session.query(
-                        db.func.coalesce(db.func.sum(CreditGroup.max_credit), 0)
-                    )
-                    .join(
-                        CreditGroupUser,
-                        CreditGroup.id == CreditGroupUser.credit_group_id,
-                    )
-                    .filter(CreditGroupUser.user_id == user["id"])
-                    .scalar()
-                )
-                max_credits = base_allowance + group_allowances
+                max_credits = session.execute(
+                    self._max_user_credits_query(user["id"])
+                ).scalar_one()
             elif sponsored_allowance_name is not None:
-                max_credits = (
-                    session.query(SponsoredAllowance.monthly_credit_limit)
-                    .filter(SponsoredAllowance.name == sponsored_allowance_name)
-                    .scalar()
+                max_credits = session.scalar(
+                    db.select(SponsoredAllowance.monthly_credit_limit).where(
+                        SponsoredAllowance.name == sponsored_allowance_name
+                    )
                 )
             elif sponsored_allowance_id is not None:
-                max_credits = (
-                    session.query(SponsoredAllowance.monthly_credit_limit)
-                    .filter(SponsoredAllowance.id == sponsored_allowance_id)
-                    .scalar()
+                max_credits = session.scalar(
+                    db.select(SponsoredAllowance.monthly_credit_limit).where(
+                        SponsoredAllowance.id == sponsored_allowance_id
+                    )
                 )
 
         return max_credits
 
+    def get_balance_summary(self, user: dict) -> tuple[int, int]:
+        """Get a user's remaining and maximum monthly credits.
+
+        Equivalent to calling :meth:`remaining_credits` and :meth:`max_credits`
+        without a sponsored allowance, but reads the credit limit and the monthly
+        usage in a single statement.
+
+        :param user: User
+        :type user: dict
+        :return: Remaining monthly credits and maximum monthly credits
+        :rtype: tuple[int, int]
+        """
+        max_credits, used_monthly_credits = self._max_and_used_credits(
+            user["id"], None
+        )
+        return max_credits - int(used_monthly_credits), max_credits
+
+    async def aget_balance_summary(self, user: dict) -> tuple[int, int]:
+        """Awaitable variant of :meth:`get_balance_summary`.
+
+        The queries run in a worker thread so that the calling event loop keeps
+        serving other coroutines while waiting for the database.
+
+        :param user: User
+        :type user: dict
+        :return: Remaining monthly credits and maximum monthly credits
+        :rtype: tuple[int, int]
+        """
+        return await asyncio.to_thread(self.get_balance_summary, user)
+
     def remaining_credits(
         self, user: dict, sponsored_allowance_name: str = None
     ) -> tuple[int, int]:
@@ -296,22 +522,55 @@ class TokenTracker:
         logger.debug("Checking remaining credits...")
 
         if sponsored_allowance_name is not None:
-            sponsored_allowance_id = UUID(
-                get_sponsored_allowance(
-                    database_url=self.db_url, name=sponsored_allowance_name
-                )["id"]
-            )
-        else:
-            sponsored_allowance_id = None
-        user_credits_remaining = self._remaining_user_credits(
-            user, sponsored_allowance_id
+            return self._remaining_sponsored_credits(user, sponsored_allowance_name)
+        return self._remaining_user_credits(user, None), None
+
+    async def aremaining_credits(
+        self, user: dict, sponsored_allowance_name: str = None
+    ) -> tuple[int, int]:
+        """Awaitable variant of :meth:`remaining_credits`.
+
+        The queries run in a worker thread so that the calling event loop keeps
+        serving other coroutines while waiting for the database.
+
+        :param user: User
+        :type user: dict
+        :param sponsored_allowance_name: Name of the sponsored allowance
+        :type sponsored_allowance_name: str, optional
+        :return: Remaining monthly credits available to the user, and in the sponsored allowance (if specified)
+        :rtype: tuple[int, int]
+        """
+        return await asyncio.to_thread(
+            self.remaining_credits, user, sponsored_allowance_name
         )
-        total_sponsored_credits_remaining = None
-        if sponsored_allowance_name:
-            total_sponsored_credits_remaining = self._remaining_sponsored_credits(
-                sponsored_allowance_id
-            )
-        return user_credits_remaining, total_sponsored_credits_remaining
+
+    def check_limits(
+        self, model_id: str, user: dict, sponsored_allowance_name: str = None
+    ) -> tuple[bool, int | None, int | None]:
+        """Get everything needed to decide whether a user may use a model.
+
+        Combines :meth:`is_paid` and :meth:`remaining_credits`, but without a
+        sponsored allowance reads the credit limit and the monthly usage in a
+        single session.
+
+        :param model_id: ID of the model
+        :type model_id: str
+        :param user: User
+        :type user: dict
+        :param sponsored_allowance_name: Name of the sponsored allowance
+        :type sponsored_allowance_name: str, optional
+        :return: Whether the model is paid and, if it is, the remaining monthly
+            credits available to the user and in the sponsored allowance (if
+            specified)
+        :rtype: tuple[bool, int | None, int | None]
+        """
+        if not self.is_paid(model_id):
+            return False, None, None
+
+        if sponsored_allowance_name is None:
+            user_credits_remaining, _ = self.get_balance_summary(user)
+            return True, user_credits_remaining, None
+        return True, *self.remaining_credits(user, sponsored_allowance_name)
 
     def log_token_usage(
         self,
@@ -321,6 +580,7 @@ class TokenTracker:
         prompt_tokens: int,
         response_tokens: int,
         sponsored_allowance_name: str = None,
+        cached_tokens: int = 0,
     ):
         """Log the used tokens in the database
 
@@ -336,6 +596,9 @@ class TokenTracker:
         :type response_tokens: int
         :param sponsored_allowance_name: Name of the sponsored allowance to apply
         :type sponsored_allowance_name: str, optional
+        :param cached_tokens: Number of the prompt tokens that were read from the
+            provider's cache, which are charged at a discount
+        :type cached_tokens: int, optional
         """
         logging.debug(
             f"Date: {datetime.now(UTC)}Z | Email: {user.get('email')} "
@@ -343,28 +606,80 @@ class TokenTracker:
             f"| Response Tokens: {response_tokens}"
         )
 
-        with Session(self.db_engine) as session:
-            if sponsored_allowance_name is not None:
-                sponsored_allowance_id = UUID(
-                    get_sponsored_allowance(
-                        database_url=self.db_url, name=sponsored_allowance_name
-                    )["id"]
-                )
-            else:
-                sponsored_allowance_id = None
-
-            session.add(
-                TokenUsageLog(
-                    provider=provider,
-                    user_id=user.get("id"),
-                    model_id=model_id,
-                    prompt_tokens=prompt_tokens,
-                    response_tokens=response_tokens,
-                    sponsored_allowance_id=sponsored_allowance_id,
-                    log_date=datetime.now(),
+        self.log_token_usage_bulk(
+            [
+                {
+                    "provider": provider,
+                    "model_id": model_id,
+                    "user": user,
+                    "prompt_tokens": prompt_tokens,
+                    "response_tokens": response_tokens,
+                    "sponsored_allowance_name": sponsored_allowance_name,
+                    "cached_tokens": cached_tokens,
+                }
+            ]
+        )
+
+    def log_token_usage_bulk(self, entries: Iterable[dict]):
+        """Log the used tokens of several requests in the database with a single
+        INSERT statement and commit.
+
+        If the INSERT violates a constraint, e.g., because a cached ID belongs to
+        a sponsored allowance that was deleted meanwhile, the cached IDs are
+        discarded and the entries are written once more.
+
+        :param entries: The usage to log, each given as a dictionary of the
+            arguments of :meth:`log_token_usage`. An entry may also specify the
+            ``log_date`` of the usage, which defaults to the current time.
+        :type entries: Iterable[dict]
+        """
+        entries = list(entries)
+        if not entries:
+            return
+
+        try:
+            self._insert_token_usage(entries)
+        except db.exc.IntegrityError:
+            if not any(entry.get("sponsored_allowance_name") for entry in entries):
+                raise
+            self.invalidate_sponsored_allowance_ids()
+            self._insert_token_usage(entries)
+
+    def _insert_token_usage(self, entries: list[dict]):
+        """Write usage entries in a single transaction, see
+        :meth:`log_token_usage_bulk`.
+
+        :param entries: The usage to log
+        :type entries: list[dict]
+        """
+        # The usage log is append-only, so rows are inserted on a plain connection
+        # without an ORM session and its unit of work
+        with self.db_engine.begin() as connection:
+            sponsored_allowance_ids = {None: None}
+            rows = []
+            for entry in entries:
+                sponsored_allowance_name = entry.get("sponsored_allowance_name")
+                if sponsored_allowance_name not in sponsored_allowance_ids:
+                    sponsored_allowance_ids[sponsored_allowance_name] = (
+                        self._sponsored_allowance_id(
+                            sponsored_allowance_name, connection
+                        )
+                    )
+                rows.append(
+                    {
+                        "provider": entry["provider"],
+                        "user_id": entry["user"].get("id"),
+                        "model_id": entry["model_id"],
+                        "prompt_tokens": entry["prompt_tokens"],
+                        "response_tokens": entry["response_tokens"],
+                        "cached_tokens": entry.get("cached_tokens", 0),
+                        "sponsored_allowance_id": sponsored_allowance_ids[
+                            sponsored_allowance_name
+                        ],
+                        "log_date": entry.get("log_date") or datetime.now(UTC),
+                    }
                 )
-            )
-            session.commit()
+            connection.execute(TokenUsageLog.__table__.insert(), rows)
 
 
 if __name__ == "__main__":
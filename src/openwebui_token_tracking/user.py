@@ -1,7 +1,7 @@
 import sqlalchemy as sa
 from sqlalchemy.orm import Session
 
-from openwebui_token_tracking.db import init_db, User
+from openwebui_token_tracking.db import get_engine, User
 
 
 def find_user(
@@ -37,7 +37,7 @@ def find_user(
 
         user = find_user(db, email="john@example.com")
     """
-    engine = init_db(database_url)
+    engine = get_engine(database_url)
 
     conditions = []
 
@@ -2,7 +2,13 @@
 Utility functions for openwebui-token-tracking.
 """
 
-from typing import List, Tuple, Any, Optional
+import json
+import threading
+import time
+from typing import TYPE_CHECKING, Hashable, Iterator, List, Tuple, Any, Optional
+
+if TYPE_CHECKING:
+    import requests
 
 
 def pop_system_message(messages: List[dict]) -> Tuple[Optional[str], List[dict]]:
@@ -11,33 +17,156 @@ def pop_system_message(messages: List[dict]) -> Tuple[Optional[str], List[dict]]
     
     This function separates system messages from regular messages, as some APIs
     require system messages to be passed separately. It extracts the first system
-    message found and removes all system messages from the remaining list.
+    message found and removes it from the remaining list. Without a system
+    message, the given list itself is returned as the remaining list, so it must
+    not be modified by the caller.
     
     :param messages: List of message dictionaries with 'role' and 'content' keys
     :type messages: List[dict]
     :return: Tuple of (system_message, remaining_messages)
     :rtype: Tuple[Optional[str], List[dict]]
     """
-    system_message = None
-    remaining_messages = []
-    system_found = False
-    
-    for message in messages:
-        if message.get("role") == "system" and not system_found:
+    for index, message in enumerate(messages):
+        if message.get("role") == "system":
             # Extract the first system message
             content = message.get("content", "")
+            system_message = None
             if isinstance(content, str):
                 system_message = content
             elif isinstance(content, list):
                 # Handle multimodal content - extract text parts
-                text_parts = []
-                for item in content:
-                    if item.get("type") == "text":
-                        text_parts.append(item.get("text", ""))
+                text_parts = [
+                    item.get("text", "") for item in content if item.get("type") == "text"
+                ]
                 system_message = " ".join(text_parts) if text_parts else None
-            system_found = True
-            # Skip adding this system message to remaining_messages
-        else:
-            remaining_messages.append(message)
-    
-    return system_message, remaining_messages
+            # Everything around the system message is kept as is, so the rest of
+            # the list does not need to be inspected
+            return system_message, messages[:index] + messages[index + 1 :]
+
+    return None, messages
+
+
+def dump_json_body(payload: Any) -> bytes:
+    """
+    Serialize a request payload to a compact UTF-8 encoded JSON document.
+
+    Unlike passing ``json=payload`` to ``requests``, this omits the whitespace
+    after separators and does not escape non-ASCII characters, which keeps large
+    payloads (e.g., long chat histories) noticeably smaller on the wire.
+
+    :param payload: JSON-serializable payload
+    :type payload: Any
+    :return: The encoded request body
+    :rtype: bytes
+    """
+    return json.dumps(
+        payload, separators=(",", ":"), ensure_ascii=False, allow_nan=False
+    ).encode("utf-8")
+
+
+def iter_sse_lines(response: "requests.Response") -> Iterator[bytes]:
+    """
+    Iterate over the non-empty lines of a streamed server-sent events response.
+
+    Unlike :meth:`requests.Response.iter_lines`, this reads whatever the server
+    has sent so far instead of fixed-size 512 byte chunks, and keeps the lines as
+    bytes so that callers only decode (or parse) the lines they need.
+
+    :param response: Response of a request made with ``stream=True``
+    :type response: requests.Response
+    :return: Lines without their line terminators
+    :rtype: Iterator[bytes]
+    """
+    pending = b""
+    for chunk in response.iter_content(chunk_size=None):
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line:
+                yield line
+    pending = pending.rstrip(b"\r")
+    if pending:
+        yield pending
+
+
+class TTLCache:
+    """
+    A minimal in-process cache whose entries expire a fixed time after being set.
+
+    Used to memoize database reads that are requested much more often than the
+    underlying data changes. Once ``maxsize`` entries are stored, expired entries
+    are purged and, if necessary, the oldest entries are evicted. The cache is
+    safe to use from multiple threads.
+
+    :param ttl: Time in seconds after which an entry expires
+    :type ttl: float
+    :param maxsize: Maximum number of entries to keep
+    :type maxsize: int, optional
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: dict[Hashable, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return the value for ``key`` if it is present and has not expired.
+
+        :param key: Cache key
+        :type key: Hashable
+        :param default: Value to return on a cache miss
+        :type default: Any, optional
+        :return: The cached value, or ``default``
+        :rtype: Any
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Store ``value`` under ``key``, replacing any previous entry.
+
+        :param key: Cache key
+        :type key: Hashable
+        :param value: Value to cache
+        :type value: Any
+        """
+        with self._lock:
+            now = time.monotonic()
+            if key not in self._data and len(self._data) >= self.maxsize:
+                for k, (expires_at, _) in list(self._data.items()):
+                    if expires_at < now:
+                        del self._data[k]
+                while len(self._data) >= self.maxsize:
+                    del self._data[next(iter(self._data))]
+            self._data[key] = (now + self.ttl, value)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove ``key`` from the cache.
+
+        :param key: Cache key
+        :type key: Hashable
+        :param default: Value to return if the key is not cached
+        :type default: Any, optional
+        :return: The removed value (even if expired), or ``default``
+        :rtype: Any
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,186 @@
+import asyncio
+
+import pytest
+from dotenv import find_dotenv, load_dotenv
+from pydantic import BaseModel
+
+from openwebui_token_tracking.pipes.azure_openai import AzureOpenAITrackedPipe
+from openwebui_token_tracking.pipes.base_tracked_pipe import BaseTrackedPipe, TokenCount
+from openwebui_token_tracking.tracking import MonthlyTokenLimitExceededError
+
+from fixtures import user
+
+
+load_dotenv(find_dotenv())
+
+
+class FakePipe(BaseTrackedPipe):
+    """Pipe answering every request with the same chunks and recording the usage
+    it would log"""
+
+    class Valves(BaseModel):
+        CACHE_ENABLED: bool = False
+        DEBUG: bool = False
+
+    CHUNKS = ["Hello", ", ", "world"]
+
+    def __init__(self):
+        super().__init__(provider="fake", url="")
+        self.logged = []
+        self.payloads = 0
+        self.stream_closed = False
+
+    def _headers(self):
+        return {}
+
+    def _payload(self, model_id, body):
+        self.payloads += 1
+        return {"model": model_id, "messages": body["messages"]}
+
+    def _tokens(self):
+        tokens = TokenCount()
+        tokens.prompt_tokens = 3
+        tokens.response_tokens = len(self.CHUNKS)
+        return tokens
+
+    def _make_stream_request(self, headers, payload):
+        def generate():
+            try:
+                yield from self.CHUNKS
+            finally:
+                self.stream_closed = True
+
+        return self._tokens(), generate()
+
+    def _make_non_stream_request(self, headers, payload):
+        return self._tokens(), "".join(self.CHUNKS)
+
+    def _check_limits(self, model_id, user, sponsored_allowance_name=None):
+        return True
+
+    def _log_token_usage(self, model_id, user, tokens, sponsored_allowance_name=None):
+        self.logged.append((model_id, tokens.prompt_tokens, tokens.response_tokens))
+
+
+def run_pipe(
+    pipe, user, messages=None, stream=False, model_id="fake.model", **params
+):
+    """Run a pipe's request in a new event loop and read the whole response"""
+
+    async def run():
+        response = await pipe.pipe(
+            body={
+                "messages": messages or [{"role": "user", "content": "Hi"}],
+                "stream": stream,
+                **params,
+            },
+            __user__=user,
+            __metadata__={"model": {"id": model_id}},
+        )
+        if isinstance(response, str):
+            return response
+        return [chunk async for chunk in response]
+
+    return asyncio.run(run())
+
+
+def test_pipe_non_stream(user):
+    pipe = FakePipe()
+    assert run_pipe(pipe, user) == "Hello, world"
+    assert pipe.logged == [("model", 3, 3)]
+
+
+def test_pipe_stream(user):
+    pipe = FakePipe()
+    assert run_pipe(pipe, user, stream=True) == FakePipe.CHUNKS
+    assert pipe.logged == [("model", 3, 3)]
+    assert pipe.stream_closed
+
+
+def test_pipe_stream_closed_early(user):
+    pipe = FakePipe()
+
+    async def run():
+        response = await pipe.pipe(
+            body={"messages": [{"role": "user", "content": "Hi"}], "stream": True},
+            __user__=user,
+            __metadata__={"model": {"id": "fake.model"}},
+        )
+        first_chunk = await response.__anext__()
+        await response.aclose()
+        return first_chunk
+
+    assert asyncio.run(run()) == "Hello"
+    # The provider's response is released, and no usage is logged for it
+    assert pipe.stream_closed
+    assert pipe.logged == []
+
+
+def test_pipe_response_replayed(user):
+    pipe = FakePipe()
+    pipe.valves.CACHE_ENABLED = True
+    assert run_pipe(pipe, user, temperature=0) == "Hello, world"
+    # The identical request is answered without formatting it again, but billed
+    assert run_pipe(pipe, user, temperature=0) == "Hello, world"
+    assert pipe.payloads == 1
+    assert pipe.logged == [("model", 3, 3)] * 2
+
+    # Different messages or a nonzero temperature are sent to the provider
+    run_pipe(pipe, user, [{"role": "user", "content": "Bye"}], temperature=0)
+    run_pipe(pipe, user, temperature=0.5)
+    assert pipe.payloads == 3
+
+
+def test_pipe_limit_exceeded(user, monkeypatch):
+    pipe = FakePipe()
+
+    def check_limits(**kwargs):
+        raise MonthlyTokenLimitExceededError("No credits left")
+
+    monkeypatch.setattr(pipe, "_check_limits", check_limits)
+    response = run_pipe(pipe, user, stream=True)
+    assert "MONTHLY TOKEN LIMIT EXCEEDED ERROR" in response
+    assert "No credits left" in response
+    assert pipe.logged == []
+
+
+class PayloadBuilt(Exception):
+    pass
+
+
+@pytest.fixture
+def azure_pipe(monkeypatch):
+    pipe = AzureOpenAITrackedPipe()
+    pipe.valves.MAX_INPUT_TOKENS = 10
+    monkeypatch.setattr(pipe, "_check_limits", lambda **kwargs: True)
+
+    def payload(model_id, body):
+        raise PayloadBuilt()
+
+    monkeypatch.setattr(pipe, "_payload", payload)
+    return pipe
+
+
+def test_max_input_tokens_exceeded(azure_pipe, user):
+    # About 11 tokens at four characters per token
+    response = run_pipe(
+        azure_pipe, user, [{"role": "user", "content": "x" * 44}], model_id="gpt-4o"
+    )
+    assert "INPUT TOO LONG ERROR" in response
+    assert "about 11 tokens, the limit is 10" in response
+
+
+def test_max_input_tokens_not_exceeded(azure_pipe, user):
+    with pytest.raises(PayloadBuilt):
+        run_pipe(
+            azure_pipe,
+            user,
+            [{"role": "user", "content": [{"type": "text", "text": "x" * 40}]}],
+            model_id="gpt-4o",
+        )
+
+    azure_pipe.valves.MAX_INPUT_TOKENS = 0
+    with pytest.raises(PayloadBuilt):
+        run_pipe(
+            azure_pipe, user, [{"role": "user", "content": "x" * 44}], model_id="gpt-4o"
+        )
@@ -0,0 +1,119 @@
+import os
+
+import pytest
+from dotenv import find_dotenv, load_dotenv
+
+import openwebui_token_tracking.sponsored as sp
+from openwebui_token_tracking import TokenTracker
+from openwebui_token_tracking.db import get_engine
+
+
+load_dotenv(find_dotenv())
+
+
+def base_model_ids(allowance: dict) -> set[str]:
+    return {m["base_model_id"] for m in allowance["base_models"]}
+
+
+@pytest.fixture
+def allowance():
+    name = "test sponsored allowance to change"
+    try:
+        sp.delete_sponsored_allowance(name=name)
+    except ValueError:
+        pass
+    sp.create_sponsored_allowance(
+        database_url=None,
+        sponsor_id="f12345",
+        name=name,
+        models=["model-a", "model-b"],
+        total_credit_limit=1000,
+        monthly_credit_limit=100,
+    )
+    yield name
+    for cur_name in (name, name + " renamed"):
+        try:
+            sp.delete_sponsored_allowance(name=cur_name)
+        except ValueError:
+            pass
+
+
+@pytest.fixture
+def without_returning(monkeypatch):
+    # Behave like a database that cannot return affected rows, e.g., MySQL
+    dialect = get_engine(os.environ["DATABASE_URL"]).dialect
+    monkeypatch.setattr(dialect, "delete_returning", False)
+    monkeypatch.setattr(dialect, "update_returning", False)
+
+
+def test_delete_sponsored_allowance_without_returning(allowance, without_returning):
+    sp.delete_sponsored_allowance(name=allowance)
+    with pytest.raises(KeyError):
+        sp.get_sponsored_allowance(name=allowance)
+    with pytest.raises(ValueError):
+        sp.delete_sponsored_allowance(name=allowance)
+
+
+def test_update_sponsored_allowance_without_returning(allowance, without_returning):
+    sp.update_sponsored_allowance(
+        name=allowance, new_name=allowance + " renamed", monthly_credit_limit=200
+    )
+    updated = sp.get_sponsored_allowance(name=allowance + " renamed")
+    assert updated["monthly_credit_limit"] == 200
+    assert base_model_ids(updated) == {"model-a", "model-b"}
+
+    with pytest.raises(ValueError):
+        sp.update_sponsored_allowance(name=allowance, monthly_credit_limit=300)
+
+
+def test_sponsored_allowance_ids_invalidated(allowance):
+    tracker = TokenTracker.shared(os.environ["DATABASE_URL"])
+    allowance_id = tracker._sponsored_allowance_id(allowance)
+
+    # A renamed allowance is no longer found by its old name
+    sp.update_sponsored_allowance(name=allowance, new_name=allowance + " renamed")
+    with pytest.raises(KeyError):
+        tracker._sponsored_allowance_id(allowance)
+    assert tracker._sponsored_allowance_id(allowance + " renamed") == allowance_id
+
+    # Nor is a deleted one
+    sp.delete_sponsored_allowance(name=allowance + " renamed")
+    with pytest.raises(KeyError):
+        tracker._sponsored_allowance_id(allowance + " renamed")
+
+
+def test_update_sponsored_allowance_models(allowance):
+    # Added and removed models in one update, keeping the common one
+    sp.update_sponsored_allowance(name=allowance, models=["model-b", "model-c"])
+    assert base_model_ids(sp.get_sponsored_allowance(name=allowance)) == {
+        "model-b",
+        "model-c",
+    }
+
+    # Only added models
+    sp.update_sponsored_allowance(
+        name=allowance, models=["model-a", "model-b", "model-c"]
+    )
+    assert base_model_ids(sp.get_sponsored_allowance(name=allowance)) == {
+        "model-a",
+        "model-b",
+        "model-c",
+    }
+
+    # Only removed models
+    sp.update_sponsored_allowance(name=allowance, models=["model-c"])
+    assert base_model_ids(sp.get_sponsored_allowance(name=allowance)) == {"model-c"}
+
+    # No models given leaves them unchanged, an empty list removes all
+    sp.update_sponsored_allowance(name=allowance, monthly_credit_limit=50)
+    assert base_model_ids(sp.get_sponsored_allowance(name=allowance)) == {"model-c"}
+    sp.update_sponsored_allowance(name=allowance, models=[])
+    assert base_model_ids(sp.get_sponsored_allowance(name=allowance)) == set()
+
+
+def test_iter_sponsored_allowances(allowance):
+    allowances = list(sp.iter_sponsored_allowances(sponsor_id="f12345"))
+    names = [a["name"] for a in allowances]
+    assert allowance in names
+    assert names == sorted(names)
+    assert allowances == sp.get_sponsored_allowances(sponsor_id="f12345")
@@ -1,5 +1,18 @@
+import asyncio
+import os
+from datetime import datetime, UTC
+
+import sqlalchemy as sa
+
 from dotenv import find_dotenv, load_dotenv
 
+from openwebui_token_tracking import TokenTracker
+from openwebui_token_tracking.db.token_usage import TokenUsageLog
+from openwebui_token_tracking.model_pricing import (
+    get_model_pricing,
+    update_model_pricing,
+)
+
 from fixtures import (
     user,
     with_credit_group,
@@ -62,3 +75,145 @@ def test_log_token_usage(tracker, model, user, with_sponsored_allowance):
 
 def test_is_paid(tracker, model):
     assert tracker.is_paid(model["id"])
+
+
+def test_get_balance_summary(tracker, user, with_credit_group):
+    credits_left, max_credits = tracker.get_balance_summary(user)
+    assert max_credits == tracker.max_credits(user)
+    assert credits_left == tracker.remaining_credits(user)[0]
+
+
+def test_aget_balance_summary(tracker, user, with_credit_group):
+    assert asyncio.run(tracker.aget_balance_summary(user)) == (
+        tracker.get_balance_summary(user)
+    )
+
+
+def test_shared_tracker(tracker):
+    shared = TokenTracker.shared(tracker.db_url)
+    assert shared is TokenTracker.shared(tracker.db_url)
+    assert shared is not tracker
+
+
+def test_check_limits(tracker, model, user, with_sponsored_allowance):
+    assert tracker.check_limits(model["id"], user) == (
+        True,
+        tracker.remaining_credits(user)[0],
+        None,
+    )
+    assert tracker.check_limits(
+        model["id"], user, sponsored_allowance_name=TEST_SPONSORED_ALLOWANCE_NAME
+    ) == (
+        True,
+        *tracker.remaining_credits(
+            user, sponsored_allowance_name=TEST_SPONSORED_ALLOWANCE_NAME
+        ),
+    )
+
+
+def test_get_models_cached(tracker):
+    models = tracker.get_models()
+    assert tracker.get_models() is models
+    tracker.invalidate_models_cache()
+    assert tracker.get_models() == models
+
+
+def test_log_token_usage_bulk(tracker, model, user, with_sponsored_allowance):
+    remaining_before, _ = tracker.remaining_credits(user)
+    tracker.log_token_usage_bulk(
+        [
+            {
+                "provider": model["provider"],
+                "model_id": model["id"],
+                "user": user,
+                "prompt_tokens": 1_000_000,
+                "response_tokens": 0,
+            },
+            {
+                "provider": model["provider"],
+                "model_id": model["id"],
+                "user": user,
+                "prompt_tokens": 10,
+                "response_tokens": 10,
+                "sponsored_allowance_name": TEST_SPONSORED_ALLOWANCE_NAME,
+            },
+        ]
+    )
+    assert tracker.remaining_credits(user)[0] < remaining_before
+
+
+def test_log_token_usage_cached_tokens(tracker, model, user):
+    def used_credits(**tokens):
+        remaining_before, _ = tracker.remaining_credits(user)
+        tracker.log_token_usage(
+            provider=model["provider"],
+            model_id=model["id"],
+            user=user,
+            response_tokens=0,
+            **tokens,
+        )
+        return remaining_before - tracker.remaining_credits(user)[0]
+
+    full_price = used_credits(prompt_tokens=1_000_000)
+    # Cached prompt tokens are charged with the default weight of a quarter
+    cached_price = used_credits(prompt_tokens=1_000_000, cached_tokens=1_000_000)
+    assert abs(cached_price - full_price / 4) <= 1
+
+
+def test_log_token_usage_bulk_duplicate(tracker, model, user):
+    # Usage is logged as given, even if two entries agree in every column
+    log_date = datetime(2000, 1, 1, tzinfo=UTC)
+    entry = {
+        "provider": model["provider"],
+        "model_id": model["id"],
+        "user": user,
+        "prompt_tokens": 1,
+        "response_tokens": 1,
+        "log_date": log_date,
+    }
+    logged_that_day = TokenUsageLog.log_date.between(
+        log_date, datetime(2000, 1, 2, tzinfo=UTC)
+    )
+    with tracker.db_engine.begin() as connection:
+        connection.execute(sa.delete(TokenUsageLog).where(logged_that_day))
+
+    tracker.log_token_usage_bulk([entry, dict(entry)])
+
+    with tracker.db_engine.connect() as connection:
+        log_dates = connection.scalars(
+            sa.select(TokenUsageLog.log_date).where(logged_that_day)
+        ).all()
+    assert len(log_dates) == 2
+    assert log_dates[0] == log_dates[1]
+
+
+def test_aremaining_credits(tracker, user, with_sponsored_allowance):
+    assert asyncio.run(
+        tracker.aremaining_credits(user, TEST_SPONSORED_ALLOWANCE_NAME)
+    ) == tracker.remaining_credits(user, TEST_SPONSORED_ALLOWANCE_NAME)
+
+
+def test_models_cache_invalidated_by_pricing_changes(model):
+    tracker = TokenTracker.shared(os.environ["DATABASE_URL"])
+    (pricing,) = get_model_pricing(
+        os.environ["DATABASE_URL"], model_id=model["id"], provider=model["provider"]
+    )
+    tracker.get_models()
+    try:
+        update_model_pricing(
+            os.environ["DATABASE_URL"],
+            model_id=model["id"],
+            provider=model["provider"],
+            updates={"name": "Renamed model"},
+        )
+        names = {m.id: m.name for m in tracker.get_models()}
+        assert names[model["id"]] == "Renamed model"
+    finally:
+        update_model_pricing(
+            os.environ["DATABASE_URL"],
+            model_id=model["id"],
+            provider=model["provider"],
+            updates={"name": pricing["name"]},
+        )
+    names = {m.id: m.name for m in tracker.get_models()}
+    assert names[model["id"]] == pricing["name"]
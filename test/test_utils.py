@@ -0,0 +1,103 @@
+import openwebui_token_tracking.utils as utils
+
+
+class FakeStreamResponse:
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size=None):
+        yield from self.chunks
+
+
+def test_iter_sse_lines_split_across_chunks():
+    response = FakeStreamResponse(
+        [b'data: {"a"', b": 1}\n\nda", b"ta: [DONE]\n", b"\n", b"data: last"]
+    )
+    assert list(utils.iter_sse_lines(response)) == [
+        b'data: {"a": 1}',
+        b"data: [DONE]",
+        b"data: last",
+    ]
+
+
+def test_iter_sse_lines_crlf():
+    # The CR of a CRLF may arrive in a different chunk than its LF
+    response = FakeStreamResponse(
+        [b"data: 1\r\n\r\ndata: 2\r", b"\n\r\n", b"data: 3\r"]
+    )
+    assert list(utils.iter_sse_lines(response)) == [
+        b"data: 1",
+        b"data: 2",
+        b"data: 3",
+    ]
+
+
+def test_ttl_cache_expiry(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(utils.time, "monotonic", lambda: now)
+    cache = utils.TTLCache(ttl=10)
+    cache.set("key", "value")
+
+    now += 10
+    assert cache.get("key") == "value"
+    now += 0.1
+    assert cache.get("key") is None
+    assert cache.get("key", "default") == "default"
+
+
+def test_ttl_cache_maxsize(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(utils.time, "monotonic", lambda: now)
+    cache = utils.TTLCache(ttl=10, maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Replacing an entry does not evict others
+    cache.set("b", 3)
+    assert (cache.get("a"), cache.get("b")) == (1, 3)
+
+    # The oldest entry makes room for a new one
+    cache.set("c", 4)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (None, 3, 4)
+
+    # Expired entries are purged before live ones are evicted
+    now += 5
+    cache.set("d", 5)
+    assert (cache.get("b"), cache.get("c"), cache.get("d")) == (None, 4, 5)
+    now += 6
+    cache.set("e", 6)
+    assert (cache.get("c"), cache.get("d"), cache.get("e")) == (None, 5, 6)
+
+
+def test_pop_system_message():
+    messages = [
+        {"role": "user", "content": "Hi"},
+        {"role": "system", "content": "Be brief"},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "system", "content": "Ignored"},
+    ]
+    system_message, remaining = utils.pop_system_message(messages)
+    assert system_message == "Be brief"
+    assert remaining == [messages[0], messages[2], messages[3]]
+    assert len(messages) == 4
+
+
+def test_pop_system_message_multimodal():
+    messages = [
+        {
+            "role": "system",
+            "content": [
+                {"type": "text", "text": "Be"},
+                {"type": "image_url", "image_url": {"url": "https://x"}},
+                {"type": "text", "text": "brief"},
+            ],
+        },
+        {"role": "user", "content": "Hi"},
+    ]
+    assert utils.pop_system_message(messages) == ("Be brief", [messages[1]])
+
+
+def test_pop_system_message_without_system_message():
+    messages = [{"role": "user", "content": "Hi"}]
+    system_message, remaining = utils.pop_system_message(messages)
+    assert system_message is None
+    assert remaining is messages